@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+'''Benchmarks for libLGTV_serial and lgtv-mqtt.py. Runs without a TV using the
+pseudo-terminal simulator, so it needs Linux (or another Unix).
+
+    ./benchmark.py -o results.json
+    ./benchmark.py -o new.json --compare results.json
+    ./benchmark.py --import-budget-ms 10
+
+Times are in microseconds.
+'''
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from libLGTV_serial import LGTV, all_codes
+from libLGTV_serial.simulator import TvSimulator
+
+model = '42LK450'
+
+
+def summarize(samples):
+    samples = sorted(samples)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1e6
+
+    return {
+        'count': len(samples),
+        'mean_us': statistics.mean(samples) * 1e6,
+        'p50_us': percentile(50),
+        'p90_us': percentile(90),
+        'p99_us': percentile(99),
+        'max_us': samples[-1] * 1e6,
+    }
+
+
+def measure(func, count):
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+# How long getting the command line ready may take, checked by
+# tests/test_import_time.py. The command line is started for every button
+# press on a remote, so this is latency people notice.
+import_budget_ms = 10
+
+# What the command line imports and does before it talks to the TV or broker.
+# Prints the seconds that took and if serial was imported.
+import_code = '''
+import sys, time
+start = time.perf_counter()
+import libLGTV_serial
+from libLGTV_serial.broker_client import BrokerClient
+libLGTV_serial.LGTV('42LK450')
+print(time.perf_counter() - start, 'serial' in sys.modules)
+'''
+
+
+def bench_import(count):
+    samples = []
+    imports_serial = False
+    for i in range(count):
+        output = subprocess.run([sys.executable, '-c', import_code],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.split()
+        samples.append(float(output[0]))
+        imports_serial |= output[1] == 'True'
+    result = summarize(samples)
+    result['imports_serial'] = imports_serial
+    return result
+
+
+def bench_init(count):
+    return measure(lambda: LGTV(model), count)
+
+
+def bench_model_resolution(count):
+    models = ['42' + suffix for suffix in all_codes]
+    return measure(lambda: [LGTV(m) for m in models], count)
+
+
+def bench_lookup(count):
+    tv = LGTV(model)
+    return measure(lambda: tv.lookup('inputhdmi1', None), count)
+
+
+def bench_insert_data(count):
+    code = LGTV(model).codes['volumelevel']
+    return measure(lambda: LGTV.insert_data(code, 20), count)
+
+
+def bench_data_to_int(count):
+    return measure(lambda: LGTV.data_to_int(b'1a'), count)
+
+
+def bench_send(count, keep_open):
+    with TvSimulator(model) as sim:
+        tv = LGTV(model, sim.port)
+        if keep_open:
+            tv.open()
+        tv.send('poweron')
+        result = measure(lambda: tv.send('volumelevel'), count)
+        tv.close()
+    return result
+
+
+class NullMqttClient:
+    def publish(self, topic, message, qos=0, retain=False):
+        pass
+
+
+def load_lgtv_mqtt():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lgtv-mqtt.py')
+    spec = importlib.util.spec_from_file_location('lgtv_mqtt', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_update_all(count):
+    lgtv_mqtt = load_lgtv_mqtt()
+    with TvSimulator(model) as sim:
+        tv = lgtv_mqtt.TvWrapper(LGTV(model, sim.port))
+        tv.command('poweron')
+        tv.power_state.wait()
+        # Polls are far enough apart in practice that the cache has expired
+        tv.tv.disable_cache()
+        controller = lgtv_mqtt.TvController(tv, 'lgtv/', timedelta(0), NullMqttClient())
+
+        def update_all():
+            # Poll every time, not just when the next one is due
+            controller.next_update = datetime.min
+            controller.update_all()
+
+        result = measure(update_all, count)
+        tv.tv.close()
+    return result
+
+
+def run(count):
+    results = {
+        'import': bench_import(max(count // 10, 5)),
+        'init': bench_init(count * 10),
+        'model_resolution': bench_model_resolution(count),
+        'lookup': bench_lookup(count * 10),
+        'insert_data': bench_insert_data(count * 10),
+        'data_to_int': bench_data_to_int(count * 10),
+        'send_one_shot': bench_send(count, False),
+        'send_keep_open': bench_send(count, True),
+    }
+    try:
+        import paho.mqtt.client
+    except ImportError:
+        print('paho-mqtt is not installed, skipping update_all', file=sys.stderr)
+    else:
+        # update_all() prints what it's doing, don't let that slow it down
+        stdout = sys.stdout
+        with open(os.devnull, 'w') as sys.stdout:
+            try:
+                results['update_all'] = bench_update_all(count)
+            finally:
+                sys.stdout = stdout
+    return results
+
+
+# Returns the names of benchmarks where the median got slower by more than
+# threshold (0.2 is 20%) compared to old_results
+def regressions(old_results, new_results, threshold):
+    slower = []
+    for name, new in new_results.items():
+        old = old_results.get(name)
+        if old is not None and new['p50_us'] > old['p50_us'] * (1 + threshold):
+            slower.append(name)
+    return slower
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-o', '--output', metavar='JSON_FILE')
+    parser.add_argument('-n', '--count', metavar='COUNT', type=int, default=200)
+    parser.add_argument('--compare', metavar='JSON_FILE',
+        help='Exit with an error if the medians got slower than in this file')
+    parser.add_argument('--threshold', metavar='FRACTION', type=float, default=0.2)
+    parser.add_argument('--import-budget-ms', metavar='MS', type=float,
+        help='Exit with an error if importing for the command line takes longer '
+            'than this or imports serial')
+    args = parser.parse_args()
+
+    results = run(args.count)
+    for name, result in results.items():
+        print(f'{name:20} p50 {result["p50_us"]:10.1f} us   p99 {result["p99_us"]:10.1f} us')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2)
+
+    if args.import_budget_ms is not None:
+        result = results['import']
+        if result['imports_serial']:
+            sys.exit('Importing for the command line imported serial')
+        if result['p50_us'] > args.import_budget_ms * 1000:
+            sys.exit(f'Importing for the command line took {result["p50_us"] / 1000:.1f} ms, '
+                f'over the budget of {args.import_budget_ms} ms')
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old_results = json.load(f)['results']
+        slower = regressions(old_results, results, args.threshold)
+        if slower:
+            sys.exit('Slower than before: ' + ', '.join(slower))
+
+
+if __name__ == '__main__':
+    main()
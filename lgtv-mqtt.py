@@ -2,25 +2,66 @@
 
 from argparse import ArgumentParser
 from datetime import datetime, timedelta
+import json
+import threading
 import time
+import traceback
 
 import paho.mqtt.client as mqtt
 
-from libLGTV_serial import LGTV
+from libLGTV_serial import LGTV, RetryPolicy
+from libLGTV_serial.bus import LGTVBus
+from libLGTV_serial.hotplug import DeviceWatcher
+from libLGTV_serial.metrics import CommandMetrics
+from libLGTV_serial.power import BUFFERED, ON, WARMING, COOLING, PowerStateMachine
+from libLGTV_serial.recorder import Recorder, Replay
+from libLGTV_serial.scheduler import CommandScheduler
 
 
 class FakeTvWrapper:
+    fake = True
+
     def __init__(self):
         self.power = False
         self.input = 'hdmi1'
         self.volume = 0
+        self.scheduler = CommandScheduler(self.command, {}, deferred=True)
+        self.metrics = None
 
-    def command(self, name, data=None):
-        print('Command:', name)
-        print('NOTE: Can\'t fake commands')
+    @property
+    def is_on(self):
+        return self.power
+
+    @property
+    def ready(self):
+        return self.power
+
+    def step(self):
         return None
 
-    def inc_or_dec_volume(self, inc):
+    def device_changed(self, present):
+        pass
+
+    def snapshot(self):
+        if not self.power:
+            return {'powerstatus': 0}
+        return {'powerstatus': 1, 'inputstatus': self.input, 'volumelevel': self.volume}
+
+    def command(self, name, data=None, callback=None):
+        print('Command:', name)
+        status = None
+        if name in ('poweron', 'poweroff'):
+            self.power = name == 'poweron'
+            status = True
+        elif name == 'powerstatus':
+            status = int(self.power)
+        else:
+            print('NOTE: Can\'t fake commands')
+        if callback is not None:
+            callback(status)
+        return status
+
+    def inc_or_dec_volume(self, inc, steps=1):
         if inc and self.volume < 100:
             self.volume += 1
         elif self.volume > 100:
@@ -28,29 +69,77 @@ class FakeTvWrapper:
 
 
 class TvWrapper:
-    def __init__(self, model, serial):
-        self.tv = LGTV(model, serial)
+    fake = False
+
+    def __init__(self, tv):
+        self.tv = tv.open()
+        # Lets the read back after setting something use the reply to the set
+        self.tv.enable_cache(1.0)
+        # Don't hold up the other TVs on the device for long if the adapter is
+        # missing, but give the TV a second chance if it didn't reply.
+        self.tv.open_retry = RetryPolicy(timeout=2)
+        self.tv.command_retry = RetryPolicy(attempts=2, timeout=3)
         self.last_known_input = None
         self.last_known_volume = None
+        # Holds back input and volume commands while the TV is turning on
+        self.power_state = PowerStateMachine(self.tv)
+        self.scheduler = CommandScheduler(self.command, self.tv.codes, deferred=True)
+        self.metrics = CommandMetrics()
+        self.tv.add_hook(self.metrics)
 
-    def command(self, name, data=None):
+    def command(self, name, data=None, callback=None):
         print('Command:', name)
-        status = self.tv.send(name, data)
+        status = self.power_state.send(name, data, callback)
         print('Command status:', repr(status))
         return status
 
+    # On or turning on, only asks the TV if it's not in the middle of either
     @property
     def power(self):
-        return bool(self.command('powerstatus'))
+        return self.power_state.refresh()
 
     @power.setter
     def power(self, set_to_on):
         self.command('poweron' if set_to_on else 'poweroff')
 
+    @property
+    def is_on(self):
+        return self.power_state.is_on
+
+    # If the TV takes commands other than power commands
+    @property
+    def ready(self):
+        return self.power_state.ready
+
+    # Returns the seconds until it should be called again or None
+    def step(self):
+        return self.power_state.step()
+
+    def device_changed(self, present):
+        self.tv.device_changed(present)
+
+    # Everything LGTV.snapshot() returns, but only powerstatus, and without
+    # asking, while the TV is turning on or off.
+    def snapshot(self):
+        power_state = self.power_state
+        if power_state.state in (WARMING, COOLING):
+            return {'powerstatus': int(power_state.is_on)}
+        print('Snapshot')
+        status = self.tv.snapshot()
+        print('Snapshot status:', status)
+        power_state.update('powerstatus', status['powerstatus'])
+        if power_state.state == WARMING:
+            if any(value is not None for key, value in status.items() if key != 'powerstatus'):
+                # Turned on some other way a while ago, it's already taking commands
+                power_state.set_state(ON)
+            else:
+                return {'powerstatus': 1}
+        return status
+
     @property
     def input(self):
         value = self.command('inputstatus')
-        if value is None:
+        if value is None or value is BUFFERED:
             return self.last_known_input
         self.last_known_input = value
         return value
@@ -62,7 +151,7 @@ class TvWrapper:
     @property
     def volume(self):
         value = self.command('volumelevel')
-        if value is None:
+        if value is None or value is BUFFERED:
             return self.last_known_volume
         self.last_known_volume = value
         return value
@@ -71,13 +160,27 @@ class TvWrapper:
     def volume(self, volume):
         self.command('volumelevel', volume)
 
-    def inc_or_dec_volume(self, inc):
-        self.command('volume' + ('up' if inc else 'down'))
+    def inc_or_dec_volume(self, inc, steps=1):
+        self.command('volume' + ('up' if inc else 'down'), steps)
 
 
-class LgtvMqttClient:
-    def __init__(self, tv, topic_prefix, update_interval):
+class TvController:
+    '''Connects one TV to MQTT.
+
+    The TV is polled every update_interval, backing off by doubling that up to
+    max_interval while nothing changes. For fast_window after a command or the
+    TV turning on, it's polled every fast_interval instead. Input and volume
+    aren't polled while the TV is off or still turning on. States are
+    published retained and only when they change.
+    '''
+
+    def __init__(self, tv, topic_prefix, update_interval, client, metrics_interval=None,
+            max_interval=None, fast_interval=timedelta(seconds=1),
+            fast_window=timedelta(seconds=10)):
         self.tv = tv
+        self.client = client
+        # Set by the SerialWorker running this TV's commands
+        self.wake = None
 
         self.topic_prefix = topic_prefix
         self.get_power_topic = topic_prefix + 'power'
@@ -87,53 +190,253 @@ class LgtvMqttClient:
         self.get_volume_topic = topic_prefix + 'volume'
         self.set_volume_topic = self.get_volume_topic + '/set'
         self.direct_command_topic = topic_prefix + 'command'
+        self.metrics_topic = topic_prefix + 'metrics'
+        # online or offline, depending on if the serial device is there
+        self.availability_topic = topic_prefix + 'availability'
+        self.available = True
+        # Last message published to each topic
+        self.published = {}
 
         self.update_interval = update_interval
-        self.last_update = datetime.min
-
-        self.client = mqtt.Client()
-        self.client.on_connect = self.on_connect
-        self.client.on_disconnect = self.on_disconnect
-        self.client.on_message = self.on_message
-        self.connected = False
-
+        self.max_interval = max_interval if max_interval is not None else update_interval * 8
+        self.fast_interval = fast_interval
+        self.fast_window = fast_window
+        self.interval = update_interval
+        self.next_update = datetime.min
+        self.fast_until = datetime.min
+        self.power = None
+        # When the TV's power state needs to be stepped, see TvWrapper.step()
+        self.step_due = None
+        # How often to publish metrics, None to not publish them
+        self.metrics_interval = metrics_interval
+        self.last_metrics = datetime.now()
+
+    # Returns True if message was different than the last one published
     def publish(self, topic, message):
+        if self.published.get(topic) == message:
+            return False
         print(f'Publish: {topic}: {message}')
-        self.client.publish(topic, message, qos=2)
+        self.client.publish(topic, message, qos=2, retain=True)
+        self.published[topic] = message
+        return True
 
-    def update_power_to(self, set_to_on):
-        if set_to_on:
-            # Reset the last update it doesn't undo the fake power on status in
-            # below in on_message.
-            self.last_update = datetime.now()
-        self.publish(self.get_power_topic, 'ON' if set_to_on else 'OFF')
+    # Poll every fast_interval for a while
+    def poll_fast(self):
+        now = datetime.now()
+        self.fast_until = now + self.fast_window
+        self.interval = self.update_interval
+        self.next_update = min(self.next_update, now + self.fast_interval)
 
-    def update_power(self):
-        self.update_power_to(tv.power)
+    def update_power_to(self, set_to_on):
+        if set_to_on and not self.power:
+            self.poll_fast()
+        self.power = set_to_on
+        return self.publish(self.get_power_topic, 'ON' if set_to_on else 'OFF')
+
+    # Publishes what's in a snapshot of the TV, returns True if anything changed
+    def update_from(self, status):
+        changed = self.update_power_to(self.tv.is_on)
+        value = status.get('inputstatus')
+        if value is not None:
+            changed = self.publish(self.get_input_topic, value) or changed
+        value = status.get('volumelevel')
+        if value is not None:
+            changed = self.publish(self.get_volume_topic, str(value)) or changed
+        return changed
 
-    def update_input(self):
-        value = self.tv.input
+    def update_all(self):
+        now = datetime.now()
+        if now < self.next_update:
+            return
+        scheduler = self.tv.scheduler
+        print(f'Updating {self.topic_prefix}... (queued: {scheduler.depth}, '
+            f'coalesced: {scheduler.coalesced}, dropped: {scheduler.dropped})')
+        # Commands that came in while polling go first, so they never wait for
+        # more than one snapshot, even if it's timing out.
+        scheduler.run_pending()
+        changed = self.update_from(self.tv.snapshot())
+
+        if changed:
+            self.interval = self.update_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        interval = self.fast_interval if now < self.fast_until else self.interval
+        self.next_update = now + interval
+
+    def publish_metrics(self):
+        now = datetime.now()
+        if (self.metrics_interval is None or self.tv.metrics is None or
+                (now - self.last_metrics) < self.metrics_interval):
+            return
+        scheduler = self.tv.scheduler
+        metrics = self.tv.metrics.snapshot()
+        metrics['queue'] = {
+            'depth': scheduler.depth,
+            'coalesced': scheduler.coalesced,
+            'merged': scheduler.merged,
+            'dropped': scheduler.dropped,
+        }
+        self.client.publish(self.metrics_topic, json.dumps(metrics))
+        self.last_metrics = now
+
+    # Seconds until update_all(), publish_metrics() or stepping the power
+    # state has something to do
+    def update_due_in(self):
+        due = self.next_update
+        if self.step_due is not None:
+            due = min(due, self.step_due)
+        # Fake TVs don't have metrics to publish
+        if self.metrics_interval is not None and self.tv.metrics is not None:
+            due = min(due, self.last_metrics + self.metrics_interval)
+        return (due - datetime.now()).total_seconds()
+
+    def step(self):
+        due = self.tv.step()
+        self.step_due = None if due is None else datetime.now() + timedelta(seconds=due)
+
+    def work(self):
+        self.tv.scheduler.run_pending()
+        self.step()
+        self.update_all()
+        self.step()
+        self.publish_metrics()
+
+    def subscribe(self, client):
+        # Publish everything again in case the broker lost it
+        self.published.clear()
+        client.subscribe(self.topic_prefix + '+/set')
+        client.subscribe(self.direct_command_topic)
+        if self.wake is not None:
+            self.wake.set()
+
+    # Called by the SerialWorker when the serial device comes or goes
+    def set_available(self, available):
+        if available != self.available:
+            self.available = available
+            self.tv.device_changed(available)
+            if available:
+                # Find out what happened while it was gone right away
+                self.next_update = datetime.min
+        self.publish(self.availability_topic, 'online' if available else 'offline')
+
+    def handles(self, topic):
+        return topic in (self.set_power_topic, self.set_input_topic,
+            self.set_volume_topic, self.direct_command_topic)
+
+    # value is a level or UP or DOWN, optionally followed by how many steps,
+    # like "UP 5"
+    @staticmethod
+    def volume_command(value):
+        parts = value.split()
+        inc = {'UP': True, 'DOWN': False}.get(parts[0])
+        if inc is None:
+            return 'volumelevel', int(value)
+        steps = int(parts[1]) if len(parts) > 1 else None
+        return 'volume' + ('up' if inc else 'down'), steps
+
+    # Warming up counts as on, the TV took the poweron
+    def publish_power(self, status):
+        self.update_power_to(self.tv.is_on)
+
+    def publish_input(self, value):
         if value is not None:
             self.publish(self.get_input_topic, value)
 
-    def update_volume(self):
-        value = self.tv.volume
+    def publish_volume(self, value):
         if value is not None:
             self.publish(self.get_volume_topic, str(value))
 
-    def update_all(self):
-        now = datetime.now()
-        if (now - self.last_update) >= self.update_interval:
-            print('Updating...')
-            self.update_power()
-            self.update_input()
-            self.update_volume()
-            self.last_update = now
+    def submit(self, command, data=None, callback=None):
+        if not self.tv.scheduler.submit(command, data, callback):
+            print(f'Too many commands queued for {self.topic_prefix}, dropped {command}')
+
+    # This is called on the MQTT network thread, so it must not touch the serial
+    # port. Commands are queued and run by the TV's worker, so a burst of them,
+    # like from a volume slider, is coalesced by the scheduler.
+    def on_message(self, topic, m):
+        if topic == self.set_power_topic:
+            set_to_on = {'ON': True, 'OFF': False}[m]
+            self.submit('poweron' if set_to_on else 'poweroff')
+            self.submit('powerstatus', callback=self.publish_power)
+        elif topic == self.set_input_topic:
+            self.submit('input' + m)
+            self.submit('inputstatus', callback=self.publish_input)
+        elif topic == self.set_volume_topic:
+            self.submit(*self.volume_command(m))
+            self.submit('volumelevel', callback=self.publish_volume)
+        elif topic == self.direct_command_topic:
+            if self.tv.fake:
+                print('TV is fake, ignoring direct command')
+            else:
+                self.submit(m)
+        self.poll_fast()
+        if self.wake is not None:
+            self.wake.set()
+
+
+class SerialWorker(threading.Thread):
+    '''Runs commands and polls for the TVs on one serial device, so a slow TV
+    only holds up the TVs that share its port. While the device is gone,
+    nothing is sent and commands wait in the queue until it's back. watch is
+    False if the device doesn't have to be there, like for fake TVs.
+    '''
+
+    def __init__(self, name, controllers, watch=True):
+        super().__init__(name=name, daemon=True)
+        self.controllers = controllers
+        self.watch = watch
+        # Set by device_changed()
+        self.present = True
+        self.wake = threading.Event()
+        for controller in controllers:
+            controller.wake = self.wake
+
+    # Called by the DeviceWatcher from its thread
+    def device_changed(self, present):
+        print(f'{self.name} {"is back" if present else "is gone"}')
+        self.present = present
+        self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.clear()
+            present = self.present
+            for controller in self.controllers:
+                try:
+                    controller.set_available(present)
+                    if present:
+                        controller.work()
+                except Exception:
+                    # Keep going, the TV or device might come back
+                    traceback.print_exc()
+            if present:
+                timeout = max(min(c.update_due_in() for c in self.controllers), 0)
+            else:
+                timeout = None
+            self.wake.wait(timeout)
+
+
+class LgtvMqttClient:
+    def __init__(self, tv_configs):
+        self.client = mqtt.Client()
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.connected = False
+        # Wait longer between each failed attempt to reconnect to the broker
+        self.reconnect_retry = RetryPolicy(delay=1, max_delay=60, jitter=0.2)
+
+        self.workers = make_workers(tv_configs, self.client)
+        self.controllers = [c for worker in self.workers for c in worker.controllers]
+        self.watcher = DeviceWatcher()
+        for worker in self.workers:
+            if worker.watch:
+                worker.present = self.watcher.watch(worker.name, worker.device_changed)
 
     def on_connect(self, client, userdata, flags, rc):
         print('Connected to broker with result code ' + str(rc))
-        client.subscribe(self.topic_prefix + '+/set')
-        client.subscribe(self.direct_command_topic)
+        for controller in self.controllers:
+            controller.subscribe(client)
         self.connected = True
 
     def on_disconnect(self, client, userdata, rc):
@@ -143,31 +446,13 @@ class LgtvMqttClient:
     def on_message(self, client, userdata, msg):
         m = msg.payload.decode()
         print(f'Received: {msg.topic}: {m}')
-        if msg.topic == self.set_power_topic:
-            set_to_on = {'ON': True, 'OFF': False}[m]
-            self.tv.power = set_to_on
-            if set_to_on:
-                # If off, it will take a while for it to report that it's on
-                # and this is a pain to deal with. Just pretend it turned on
-                # successfully.
-                self.update_power_to(True)
-            else:
-                self.update_power()
-        elif msg.topic == self.set_input_topic:
-            self.tv.input = m
-            self.update_input()
-        elif msg.topic == self.set_volume_topic:
-            inc = {'UP': True, 'DOWN': False}.get(m)
-            if inc is None:
-                self.tv.volume = int(m)
-            else:
-                self.tv.inc_or_dec_volume(inc)
-            self.update_volume()
-        elif msg.topic == self.direct_command_topic:
-            if self.tv.fake:
-                print('TV is fake, ignoring direct command')
-            else:
-                self.tv.command(m)
+        for controller in self.controllers:
+            if controller.handles(msg.topic):
+                try:
+                    controller.on_message(msg.topic, m)
+                except Exception:
+                    # Like a bad payload, don't let it take down the network loop
+                    traceback.print_exc()
 
     def start(self, *args):
         print('Trying to connect...')
@@ -176,29 +461,148 @@ class LgtvMqttClient:
         except OSError:
             print('Failed, going to try again...')
 
+        self.watcher.start()
+        for worker in self.workers:
+            worker.start()
+
+        retries = None
         while True:
             self.client.loop()
             if self.connected:
-                self.update_all()
+                retries = None
+                continue
+            if retries is None:
+                retries = self.reconnect_retry.delays()
+            print('Trying to reconnect...')
+            try:
+                self.client.reconnect()
+            except OSError:
+                delay = next(retries)
+                print(f'Failed, going to try again in {delay:.1f} seconds...')
+                time.sleep(delay)
+
+
+# Returns a SerialWorker for each serial device in tv_configs. Each config is a
+# dict with at least "model" and optionally "serial", "set_id", "topic_prefix",
+# "interval", "max_interval", "fast_interval", "fast_window", "metrics_interval"
+# (all in seconds, see TvController) and "fake". "baudrate" is the baud rate of
+# the serial device or "auto" to find the fastest one that works. "record" is a file to record the
+# serial traffic to and "replay" is a recording to use instead of the serial
+# device, played back "replay_speed" times faster than recorded or as fast as
+# possible if it's null. "debounce" maps commands to seconds to debounce them
+# for and "rate_limit" maps them to how many can be sent a second, see
+# LGTV.debounce() and LGTV.rate_limit(). TVs sharing a serial device need
+# different set IDs.
+def make_workers(tv_configs, client):
+    by_serial = {}
+    for config in tv_configs:
+        by_serial.setdefault(config.get('serial', LGTV.default_serial), []).append(config)
+
+    # By path, so TVs recording to or replaying the same file share it
+    recorders = {}
+    replays = {}
+
+    # opener is what opens the serial device, the bus or the TV
+    def set_up_recording(opener, config):
+        path = config.get('record')
+        if path is not None:
+            if path not in recorders:
+                recorders[path] = Recorder(path)
+            opener.recorder = recorders[path]
+        path = config.get('replay')
+        if path is not None:
+            if path not in replays:
+                replays[path] = Replay(path, config.get('replay_speed', 1.0))
+            opener.transport = replays[path].open
+
+    def set_baudrate(lgtv, config):
+        baudrate = config.get('baudrate')
+        if baudrate == 'auto':
+            if lgtv.probe_baudrate() is None:
+                print(f'{lgtv.port} did not reply at any baud rate, using the default')
+        elif baudrate is not None:
+            lgtv.serial_settings['baudrate'] = baudrate
+            if lgtv.bus is not None:
+                lgtv.bus.serial_settings['baudrate'] = baudrate
+
+    workers = []
+    for serial, configs in by_serial.items():
+        bus = LGTVBus(serial) if len(configs) > 1 else None
+        controllers = []
+        for config in configs:
+            if config.get('fake', False):
+                tv = FakeTvWrapper()
             else:
-                print('Trying to reconnect...')
-                try:
-                    self.client.reconnect()
-                except OSError:
-                    print('Failed, going to try again...')
-                time.sleep(1)
+                if bus is not None:
+                    set_up_recording(bus, config)
+                    lgtv = bus.add(config['model'], config['set_id'])
+                else:
+                    lgtv = LGTV(config['model'], serial, set_id=config.get('set_id', 0))
+                    set_up_recording(lgtv, config)
+                set_baudrate(lgtv, config)
+                for command, wait_secs in config.get('debounce', {}).items():
+                    lgtv.debounce(command, wait_secs)
+                for command, rate in config.get('rate_limit', {}).items():
+                    lgtv.rate_limit(command, rate)
+                tv = TvWrapper(lgtv)
+            def seconds(key, default=None):
+                value = config.get(key, default)
+                return None if value is None else timedelta(seconds=value)
+
+            controllers.append(TvController(tv, config.get('topic_prefix', 'lgtv/'),
+                seconds('interval', 15), client, seconds('metrics_interval'),
+                seconds('max_interval'), seconds('fast_interval', 1),
+                seconds('fast_window', 10)))
+        # Fake and replayed TVs don't need the device
+        watch = any(not config.get('fake', False) and config.get('replay') is None
+            for config in configs)
+        workers.append(SerialWorker(serial, controllers, watch))
+    return workers
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
-    parser.add_argument('model', metavar='MODEL')
+    parser.add_argument('model', metavar='MODEL', nargs='?',
+        help='Model of the TV, if not using --config')
     parser.add_argument('broker', metavar='MQTT_BROKER')
+    parser.add_argument('--config', '-c', metavar='JSON_FILE',
+        help='JSON file with a list of TVs, see make_workers() for the format')
     parser.add_argument('--serial', '-s', metavar='SERIAL_DEVICE', default=LGTV.default_serial)
+    parser.add_argument('--set-id', '-i', metavar='SET_ID', type=int, default=0)
     parser.add_argument('--topic-prefix', metavar='MQTT_TOPIC_PREFIX', default='lgtv/')
     parser.add_argument('--interval', metavar='SECONDS', type=int, default=15)
+    parser.add_argument('--max-interval', metavar='SECONDS', type=int,
+        help='Poll less often, up to this, while nothing changes (default: 8 intervals)')
+    parser.add_argument('--metrics-interval', metavar='SECONDS', type=int,
+        help='Publish command latency and error metrics this often')
     parser.add_argument('--fake', action='store_true')
+    parser.add_argument('--record', metavar='FILE',
+        help='Record the serial traffic to FILE')
+    parser.add_argument('--replay', metavar='FILE',
+        help='Replay a recording made using --record instead of using the serial device')
+    parser.add_argument('--replay-speed', metavar='SPEED', type=float, default=1.0,
+        help='How many times faster to replay than recorded, 0 for as fast as possible')
     args = parser.parse_args()
 
-    tv = FakeTvWrapper() if args.fake else TvWrapper(args.model, args.serial)
-    client = LgtvMqttClient(tv, args.topic_prefix, timedelta(seconds=args.interval))
+    if args.config is not None:
+        with open(args.config) as f:
+            tv_configs = json.load(f)
+    elif args.model is not None:
+        tv_configs = [{
+            'model': args.model,
+            'serial': args.serial,
+            'set_id': args.set_id,
+            'topic_prefix': args.topic_prefix,
+            'interval': args.interval,
+            'max_interval': args.max_interval,
+            'metrics_interval': args.metrics_interval,
+            'fake': args.fake,
+            'record': args.record,
+            'replay': args.replay,
+            'replay_speed': args.replay_speed or None,
+        }]
+    else:
+        parser.error('Either MODEL or --config is required')
+
+    client = LgtvMqttClient(tv_configs)
     client.start(args.broker, 1883, 60)
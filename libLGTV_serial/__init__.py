@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+# serial and re are imported where they're used so that the command line starts
+# quickly, especially when it can use the broker.
 import sys
-import serial
 import os
 import time
-import tempfile
-from .filelock import FileLock
+from types import MappingProxyType
+from .filelock import device_path, open_shared, port_lock, read_shared
+from .ratelimit import (LEADING, SUPPRESSED, TRAILING, Debounce, TokenBucket, check_limit,
+    take_pending)
+from .retry import LGTVTimeoutError, RetryPolicy, remaining
 
 
 actual_codes = {}
@@ -143,13 +147,96 @@ reverse_code_map = {
     'LB5D_etc': ('LB5D', 'LB4D'),
     'C3PUA_etc': ('C3PUA',),
 }
-all_codes = {}
-# populate model suffix lookup hash
-for suffix_codes, suffixes in reverse_code_map.items():
-    for suffix in suffixes:
+# Serial port settings, passed to serial.Serial(). See LGTV.serial_settings.
+default_serial_settings = {
+    'baudrate': 9600,
+    'bytesize': 8,
+    'parity': 'N',
+    'stopbits': 1,
+    'timeout': 1,
+}
+# Table name in actual_codes -> settings that are different for those models
+model_serial_settings = {}
+# Baud rates to try in LGTV.probe_baudrate(), fastest first
+probe_baudrates = (115200, 57600, 38400, 19200, 9600)
+# Replies look like b"a 01 OK01x": the second letter of the command, the set ID
+# of the TV that replied, OK or NG, the data and then the x terminator.
+frame_pattern = rb'([a-z]) ([0-9a-fA-F]{2}) (OK|NG)((?:[0-9a-fA-F]{2})+)x$'
+frame_terminator = b'x'
+max_frame_len = 32
+# Highest level a family like b'kf' for volume can be set to, 0xfe for the
+# rest since ff is the data that queries instead of setting.
+level_maximums = {b'kf': 0x64}
+
+
+
+def read_raw_frame(connection, deadline, buf=b''):
+    '''Read up to and including the next frame terminator. Returns None if the
+    time.monotonic() deadline passes first. buf is what was already read of the
+    frame.
+    '''
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        connection.timeout = remaining
+        chunk = connection.read_until(frame_terminator, max_frame_len)
+        buf = (buf + chunk)[-max_frame_len:]
+        if chunk.endswith(frame_terminator):
+            return buf
+        if len(chunk) < max_frame_len:
+            return None # Timed out in the middle of a frame
+
+
+def open_port(get_port, policy, deadline=None, on_retry=None):
+    '''Returns get_port(), calling it again as policy allows while it raises
+    SerialException. Raises LGTVTimeoutError when giving up.
+    '''
+    import serial
+    retries = policy.delays(deadline)
+    while True:
+        try:
+            return get_port()
+        except serial.serialutil.SerialException as e:
+            delay = next(retries, None)
+            if delay is None:
+                raise LGTVTimeoutError(f'Could not open the serial device: {e}') from e
+            if on_retry is not None:
+                on_retry()
+            time.sleep(delay)
+
+
+# Name of a table in actual_codes -> read-only table merged with common_codes,
+# filled in as needed by code_table()
+code_tables = {}
+
+
+def table_name_for(suffix):
+    for table_name, suffixes in reverse_code_map.items():
+        if suffix in suffixes:
+            return table_name
+    raise KeyError(suffix)
+
+
+def code_table(suffix):
+    '''Returns the read-only command to code table for a model suffix like
+    "LK450". Raises KeyError if the model isn't supported.
+    '''
+    table_name = table_name_for(suffix)
+    table = code_tables.get(table_name)
+    if table is None:
         codes = common_codes.copy()
-        codes.update(actual_codes[suffix_codes])
-        all_codes[suffix] = codes
+        codes.update(actual_codes[table_name])
+        table = code_tables[table_name] = MappingProxyType(codes)
+    return table
+
+
+def __getattr__(name):
+    # all_codes (model suffix -> code table) used to be built on import
+    if name == 'all_codes':
+        return {suffix: code_table(suffix)
+            for suffixes in reverse_code_map.values() for suffix in suffixes}
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 
 class LGTV:
@@ -159,107 +246,346 @@ class LGTV:
     def data_to_int(data):
         return int(data.decode(), base=16)
 
-    def __init__(self, model, port=None, verbose=False):
+    def __init__(self, model, port=None, verbose=False, set_id=0):
         self.model = model.upper()
         self.verbose = verbose
+        # Set ID of the TV to talk to, 0 is every TV connected to the port
+        if set_id < 0 or set_id > 99:
+            raise ValueError(f'set ID {set_id} is not between 0 and 99')
+        self.set_id = set_id
+        # LGTVBus this TV shares its port with, if any
+        self.bus = None
 
         # Ignore digits which indicate the TV's screen size
         if model.startswith('M'):
-            self.codes = all_codes[self.model[3:]]  # Ignore the leading 'M' too
+            suffix = self.model[3:]  # Ignore the leading 'M' too
         else:
-            self.codes = all_codes[self.model[2:]]
+            suffix = self.model[2:]
+        self.codes = code_table(suffix)
+        # Settings for opening the port, like 'baudrate', see
+        # default_serial_settings. The baud rate can also be found using
+        # probe_baudrate().
+        self.serial_settings = dict(default_serial_settings,
+            **model_serial_settings.get(table_name_for(suffix), {}))
         self.inputs_by_data = {self.data_to_int(v[-2:]): k[5:] for k, v in self.codes.items()
             if k.startswith('input') and not k.endswith('status')}
 
-        self.port = port if port is not None else default_serial
+        self.port = port if port is not None else self.default_serial
+        # Seconds to wait for a complete reply, can be overridden per command
+        # using set_timeout()
+        self.response_timeout = 1.0
+        self.timeouts = {}
         self.connection = None
+        # Called to get the connection instead of opening port if set, like
+        # recorder.Replay.open
+        self.transport = None
+        # recorder.Recorder to log everything sent and received to
+        self.recorder = None
+        # If True the port stays open between send() calls, see open()
+        self.keep_open = False
+        # How to retry opening the port and commands that failed, see
+        # RetryPolicy. Commands aren't retried by default. The timeout of
+        # command_retry limits how long all of send() can take.
+        self.open_retry = RetryPolicy(timeout=10)
+        self.command_retry = RetryPolicy(attempts=1)
+        # time.monotonic() the current send() has to be done by or None
+        self.deadline = None
+        # time.monotonic() every send() and snapshot() has to be done by, no
+        # matter what command_retry allows, or None. Set by TVGroup.run().
+        self.outer_deadline = None
         self.toggles = {
             'togglepower': ('poweron', 'poweroff'),
             'togglemute': ('mute', 'unmute'),
         }
-        self.debounces = {}
+        # Command -> ratelimit.Debounce or TokenBucket, see debounce() and
+        # rate_limit()
+        self.limits = {}
+        # Last known data by command family (like b'kf' for volume) and when
+        # it was received, see enable_cache().
+        self.cache_ttl = None
+        self.cache = {}
+        # See add_hook()
+        self.hooks = []
+        self.timing_start = 0
+        self.timing = {}
+        self.last_result = None
 
     #this next line sets up the serial port to allow for communication
     #and opens the serial port you may need to change
-    #ttyS0 to S1, S2, ect. The rest shouldn't need to change.
+    #ttyS0 to S1, S2, ect. The rest are in serial_settings.
     def get_port(self):
-        return serial.Serial(self.port, 9600, 8, serial.PARITY_NONE,
-                serial.STOPBITS_ONE, xonxoff=0, rtscts=0, timeout=1)
+        if self.transport is not None:
+            ser = self.transport()
+        else:
+            import serial
+            ser = serial.Serial(self.port, xonxoff=0, rtscts=0, **self.serial_settings)
+        if self.recorder is not None:
+            ser = self.recorder.wrap(ser)
+        return ser
 
+    # Raises LGTVTimeoutError if the port couldn't be opened in the time
+    # open_retry allows, or before the deadline of the current send().
     def get_port_ensured(self):
-        ser = None
-        while ser == None:
+        return open_port(self.get_port, self.open_retry, self.deadline,
+            lambda: self.emit('open_retry'))
+
+    def connect(self, ensured=True):
+        if self.connection is None:
+            if self.bus is not None:
+                self.connection = self.bus.connect(ensured)
+            else:
+                self.connection = self.get_port_ensured() if ensured else self.get_port()
+        self.mark('port_open')
+        return self.connection
+
+    def disconnect(self):
+        if self.connection is not None:
+            import serial
             try:
-                ser = self.get_port()
+                self.connection.close()
             except serial.serialutil.SerialException:
-                time.sleep(0.07)
-        return ser
+                pass
+            self.connection = None # Serial might complain the port doesn't exist
+
+    # Keep the port open across send() calls until close() is called. The port
+    # itself is opened by the next send(). Can also be used as a context
+    # manager: `with LGTV(model) as tv: ...`
+    def open(self):
+        self.keep_open = True
+        return self
+
+    def close(self):
+        self.keep_open = False
+        self.disconnect()
+
+    # Called by hotplug.DeviceWatcher when the serial device comes or goes.
+    # The port is closed when it goes, so the next send() opens the new one.
+    def device_changed(self, present):
+        if not present:
+            self.disconnect()
+        self.emit('device_added' if present else 'device_removed')
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
 
     def status_code(self, code):
         return code[:-2] + b'ff'
 
+    # The code tables use set ID 00, replace it with the one for this TV
+    def address(self, code):
+        if self.set_id == 0:
+            return code
+        return code[:3] + f'{self.set_id:02x}'.encode() + code[5:]
+
     @staticmethod
     def insert_data(code, data_arg):
         if data_arg is not None:
             if not isinstance(data_arg, int):
-                raise TypeError(f'data {repr()} is not an int')
+                raise TypeError(f'data {data_arg!r} is not an int')
             if data_arg < 0 or data_arg > 255:
-                raise ValueError(f'data {repr()} is can not fit in a byte')
+                raise ValueError(f'data {data_arg!r} can not fit in a byte')
             code = code[:-2] + f'{data_arg:02x}'[-2:].encode()
         return code
 
-    def lookup(self, command, data_arg):
+    # Returns the status code that has to be queried before command can be
+    # looked up or None if the command doesn't depend on the current state.
+    def lookup_status_code(self, command):
         if command.startswith('toggle'):
             states = self.toggles.get(command)
-            state_codes = (self.codes[states[0]], self.codes[states[1]])
-            return self.toggle(self.status_code(state_codes[0]), state_codes)
+            return self.address(self.status_code(self.codes[states[0]]))
         elif command.endswith('up'):
-            key = command[:-2] + 'level'
-            return self.increment(self.status_code(self.codes[key]))
+            return self.address(self.status_code(self.codes[command[:-2] + 'level']))
         elif command.endswith('down'):
-            key = command[:-4] + 'level'
-            return self.decrement(self.status_code(self.codes[key]))
+            return self.address(self.status_code(self.codes[command[:-4] + 'level']))
+        return None
+
+    # For up and down commands data is how many steps to go, 1 by default
+    @staticmethod
+    def steps(data_arg):
+        if data_arg is None:
+            return 1
+        if not isinstance(data_arg, int):
+            raise TypeError(f'steps {data_arg!r} is not an int')
+        if data_arg < 0:
+            raise ValueError(f'steps {data_arg!r} is negative')
+        return data_arg
+
+    # level is the result of querying lookup_status_code(command). Returns None
+    # for up and down commands if the level couldn't be read.
+    def lookup_with_level(self, command, data_arg, level):
+        if command.startswith('toggle'):
+            states = self.toggles.get(command)
+            state_codes = (self.codes[states[0]], self.codes[states[1]])
+            return self.address(
+                self.toggle_level(self.status_code(state_codes[0]), state_codes, level))
+        elif command.endswith('up') or command.endswith('down'):
+            if command.endswith('up'):
+                key = command[:-2] + 'level'
+                delta = self.steps(data_arg)
+            else:
+                key = command[:-4] + 'level'
+                delta = -self.steps(data_arg)
+            code = self.delta_level(self.status_code(self.codes[key]), level, delta)
+            return None if code is None else self.address(code)
         else:
-            return self.insert_data(self.codes[command], data_arg)
+            return self.address(self.insert_data(self.codes[command], data_arg))
+
+    def lookup(self, command, data_arg):
+        status_code = self.lookup_status_code(command)
+        level = None if status_code is None else self.query_status(status_code)
+        return self.lookup_with_level(command, data_arg, level)
+
+    @staticmethod
+    def parse_frame(frame):
+        '''Returns (command letter, set ID, ok, data) or None if frame is garbled.
+        '''
+        import re # Caches the compiled pattern
+        match = re.search(frame_pattern, frame)
+        if match is None:
+            return None
+        command, set_id, status, data = match.groups()
+        return command, set_id.lower(), status == b'OK', data.lower()
+
+    def frame_matches(self, code, parsed):
+        command, set_id, ok, data = parsed
+        if command != code[1:2]:
+            return False
+        # Set ID 00 addresses every TV, which reply with their own set ID
+        sent_set_id = code[3:5].lower()
+        return sent_set_id == b'00' or sent_set_id == set_id
+
+    def read_frame(self, code, timeout):
+        '''Read until a reply to code is terminated or timeout seconds pass.
+        Returns the parsed reply or None on timeout.
+        '''
+        deadline = time.monotonic() + timeout
+        # Read the first byte on its own to know how long the TV took to start
+        # replying.
+        self.connection.timeout = timeout
+        frame = self.connection.read(1)
+        if not frame:
+            return None
+        self.mark('first_byte')
+        while True:
+            frame = read_raw_frame(self.connection, deadline, frame)
+            if frame is None:
+                return None
+            if self.verbose:
+                print('Receive:', frame)
+            parsed = self.parse_frame(frame)
+            # Skip stale or garbled frames, for example a late reply to a
+            # previous command.
+            if parsed is not None and self.frame_matches(code, parsed):
+                return parsed
+            frame = b''
 
-    # Returns None on error, full response otherwise
-    def query_full(self, code):
+    def timeout_for(self, command):
+        return self.timeouts.get(command, self.response_timeout)
+
+    # How long to wait for a reply, no longer than what's left before the
+    # deadline. Raises LGTVTimeoutError if nothing is.
+    def reply_timeout(self, timeout=None):
+        if timeout is None:
+            timeout = self.response_timeout
+        if self.deadline is not None:
+            timeout = min(timeout, remaining(self.deadline))
+        return timeout
+
+    # Returns None on error, parsed response otherwise
+    def query_full(self, code, timeout=None):
+        timeout = self.reply_timeout(timeout)
         if self.verbose:
             print('Send:', code)
+        self.connection.reset_input_buffer()
         self.connection.write(code + b'\r')
-        response = self.connection.read(10)
-        if self.verbose:
-            print('Receive:', response)
-        if self.is_success(response):
-            return response
+        self.mark('write')
+        parsed = self.read_frame(code, timeout)
+        self.mark('reply')
+        self.update_cache(code, parsed)
+        if parsed is None:
+            self.last_result = 'timeout'
+        elif self.is_success(parsed):
+            self.last_result = 'ok'
+            return parsed
+        else:
+            self.last_result = 'ng'
+
+    def query_data(self, code, timeout=None):
+        response = self.query_full(code, timeout)
+        return response and response[3]
+
+    # Like query_data, but uses the cache if it's enabled and fresh
+    def query_status(self, code, timeout=None):
+        data = self.cached_data(code)
+        if data is None:
+            data = self.query_data(code, timeout)
+        else:
+            self.last_result = 'cached'
+        return data
 
-    def query_data(self, code):
-        response = self.query_full(code)
-        return response and response[-3:-1]
+    def cached_data(self, code):
+        if self.cache_ttl is None:
+            return None
+        entry = self.cache.get(code[:2])
+        if entry is not None and time.monotonic() - entry[1] <= self.cache_ttl:
+            return entry[0]
+        return None
+
+    # Replies to writes carry the data that was set, so every OK reply says
+    # what the state of that family is now.
+    def update_cache(self, code, parsed):
+        if self.cache_ttl is None:
+            return
+        if parsed is not None and self.is_success(parsed) and parsed[3]:
+            self.cache[code[:2]] = (parsed[3], time.monotonic())
+        else:
+            self.cache.pop(code[:2], None)
+
+    def clear_cache(self):
+        self.cache.clear()
 
     # returns None on error, 2-char status for status commands, and True otherwise
     def query(self, command, data_arg):
         command_seq = self.lookup(command, data_arg)
-        if self.is_status(command):
-            return self.query_data(command_seq)
+        if command_seq is None:
+            # Rejected already, last_result says how
+            return None
+        timeout = self.timeout_for(command)
+        if not self.is_status(command):
+            return self.query_full(command_seq, timeout) and True
+        elif data_arg is None:
+            return self.query_status(command_seq, timeout)
         else:
-            return self.query_full(command_seq) and True
+            # Setting a level always goes to the TV, the reply updates the cache
+            return self.query_data(command_seq, timeout)
 
-    def is_status(self, command):
+    @staticmethod
+    def is_status(command):
         return command.endswith('status') or command.endswith('level')
 
     def is_success(self, response):
-        return response[-5:-3] == b'OK'
+        return response[2]
+
+    @staticmethod
+    def level_maximum(code):
+        return level_maximums.get(code[:2], 0xfe)
 
-    def hex_bytes_delta(self, hex_bytes, delta):
-        value = int(hex_bytes, 16) + delta
-        if value < 0 or value > 255:
-            raise ValueError(f'{value:02x} is out of byte range')
+    # Values past 0 and maximum are clamped to them
+    def hex_bytes_delta(self, hex_bytes, delta, maximum=0xfe):
+        value = min(max(int(hex_bytes, 16) + delta, 0), maximum)
         return bytearray(f'{value:02x}', 'ascii')
 
+    # None if level is, like when the TV didn't reply to the query for it
+    def delta_level(self, code, level, delta):
+        if level is None:
+            return None
+        return code[0:6] + self.hex_bytes_delta(level, delta, self.level_maximum(code))
+
     def delta(self, code, delta):
-        level = self.query_data(code)
-        return code[0:6] + self.hex_bytes_delta(level, delta)
+        return self.delta_level(code, self.query_status(code), delta)
 
     def increment(self, code):
         return self.delta(code, +1)
@@ -267,29 +593,332 @@ class LGTV:
     def decrement(self, code):
         return self.delta(code, -1)
 
-    def toggle(self, code, togglecommands):
-        level = self.query_data(code)
+    def toggle_level(self, code, togglecommands, level):
         toggledata = (togglecommands[0][-2:], togglecommands[1][-2:])
         data = toggledata[0]
         if level == toggledata[0]:
             data = toggledata[1]
         return code[0:6] + data
 
+    def toggle(self, code, togglecommands):
+        return self.toggle_level(code, togglecommands, self.query_status(code))
+
+    # Every transaction holds the lock for the serial device, so other LGTV
+    # objects and processes using the same device don't mix up their frames.
+    def locked_query(self, command, data_arg):
+        with self.port_lock() as lock:
+            self.emit('lock_wait', command, {'lock': 'port', 'wait': lock.wait})
+            self.mark('lock')
+            return self.query(command, data_arg)
+
+    # Waits no longer than the deadline of the current send()
+    def port_lock(self):
+        return port_lock(self.port,
+            timeout=None if self.deadline is None else remaining(self.deadline))
+
+    def send_once(self, command, data_arg):
+        self.connect()
+        return self.locked_query(command, data_arg)
+
+    # Limits are shared by everything using the same serial device, so they're
+    # by set ID too.
+    def limit_key(self, command):
+        return f'{self.set_id} {command}'
+
+    # Returns True if command can't be sent now because of debounce() or
+    # rate_limit(). Trailing edge commands are sent later by send_later().
+    def suppress(self, command, data_arg):
+        limit = self.limits.get(command)
+        # Reading a level isn't limited by a limit on setting it
+        if limit is None or (command.endswith('level') and data_arg is None):
+            return False
+        send_now, token = check_limit(limit, self.port, self.limit_key(command))
+        if token is not None:
+            self.send_later(limit.window, command, data_arg, token)
+        if not send_now:
+            self.emit('command', command, {'result': 'suppressed'})
+        return not send_now
+
+    # A copy without limits and with its own connection, to send trailing
+    # edge commands with without getting in the way of this one.
+    def unlimited_copy(self):
+        import copy
+        tv = copy.copy(self)
+        tv.limits = {}
+        tv.bus = None
+        tv.connection = None
+        tv.keep_open = False
+        return tv
+
+    # The timer isn't a daemon thread, so the command line waits for it.
+    def send_later(self, delay, command, data_arg, token):
+        import threading
+        tv = self.unlimited_copy()
+        key = self.limit_key(command)
+        def send():
+            if take_pending(self.port, key, token):
+                tv.send(command, data_arg)
+        threading.Timer(delay, send).start()
+
+    # Commands that set something to a fixed value or query it can be sent
+    # again if there was no reply or an NG. Toggles and up/down can't, the
+    # first one might have gotten through with only the reply lost.
+    def is_retryable(self, command):
+        return self.lookup_status_code(command) is None
+
+    def send_retrying(self, command, data_arg):
+        response = self.send_once(command, data_arg)
+        if response is None and self.is_retryable(command):
+            for delay in self.command_retry.delays(self.deadline):
+                self.emit('retry', command, {'result': self.last_result})
+                time.sleep(delay)
+                response = self.send_once(command, data_arg)
+                if response is not None:
+                    break
+        return response
+
+    # The deadline for a send() or snapshot() starting now
+    def call_deadline(self):
+        deadline = self.command_retry.deadline()
+        if self.outer_deadline is not None and (deadline is None or self.outer_deadline < deadline):
+            deadline = self.outer_deadline
+        return deadline
+
     def send(self, command, data_arg=None):
-        if command in self.debounces:
-            wait_secs = self.debounces[command]
-            if self.connection == None:
-                self.connection = self.get_port()
-            lock_path = os.path.join(tempfile.gettempdir(), '.' + command + '_lock')
-            with FileLock(lock_path, timeout=0) as lock:
-                response = self.query(command, data_arg)
-                time.sleep(wait_secs)
+        if self.suppress(command, data_arg):
+            return SUPPRESSED
+        import serial
+        self.start_timing()
+        self.deadline = self.call_deadline()
+        try:
+            response = self.send_retrying(command, data_arg)
+        except serial.serialutil.SerialException:
+            if not self.keep_open:
+                raise
+            # The device might have been unplugged or re-enumerated since the
+            # port was opened, reopen it and try again.
+            self.emit('reopen', command)
+            self.disconnect()
+            response = self.send_retrying(command, data_arg)
+        finally:
+            self.deadline = None
+            if not self.keep_open:
+                self.disconnect()
+            self.finish_timing(command)
+        return self.decode_response(command, response)
+
+    def status_commands(self):
+        '''Every status command the model has, powerstatus first.'''
+        return sorted((command for command in self.codes if self.is_status(command)),
+            key=lambda command: (command != 'powerstatus', command))
+
+    # Splits commands into dicts of reply command letter to (command, code),
+    # so replies in each can be told apart by the letter.
+    def pipeline_rounds(self, commands):
+        rounds = []
+        for command in commands:
+            code = self.address(self.codes[command])
+            for pending in rounds:
+                if code[1:2] not in pending:
+                    pending[code[1:2]] = (command, code)
+                    break
+            else:
+                rounds.append({code[1:2]: (command, code)})
+        return rounds
+
+    def query_pipelined(self, pending, timeout=None):
+        '''Writes every code in pending, from pipeline_rounds(), before
+        reading any replies. Returns a dict of command to what send() would
+        have returned for it.
+        '''
+        if timeout is None:
+            timeout = max(self.timeout_for(command) for command, code in pending.values())
+        timeout = self.reply_timeout(timeout)
+        self.connection.reset_input_buffer()
+        for command, code in pending.values():
+            if self.verbose:
+                print('Send:', code)
+            self.connection.write(code + b'\r')
+        self.mark('write')
+
+        results = dict.fromkeys(command for command, code in pending.values())
+        waiting = dict(pending)
+        deadline = time.monotonic() + timeout
+        while waiting:
+            frame = read_raw_frame(self.connection, deadline)
+            if frame is None:
+                break
+            if self.verbose:
+                print('Receive:', frame)
+            parsed = self.parse_frame(frame)
+            if parsed is None or parsed[0] not in waiting:
+                continue
+            command, code = waiting[parsed[0]]
+            if not self.frame_matches(code, parsed):
+                continue
+            del waiting[parsed[0]]
+            self.update_cache(code, parsed)
+            if self.is_success(parsed):
+                results[command] = self.decode_response(command, parsed[3])
+        self.mark('reply')
+        if waiting:
+            self.last_result = 'timeout'
+        elif None in results.values():
+            self.last_result = 'ng'
         else:
-            if self.connection == None:
-                self.connection = self.get_port_ensured()
-            response = self.query(command, data_arg)
-        self.connection.close()
-        self.connection = None # Serial might complain the port doesn't exist
+            self.last_result = 'ok'
+        return results
+
+    def snapshot(self, timeout=None):
+        '''Returns a dict of every status command the model has, like
+        'powerstatus' and 'volumelevel', to what send() would have returned
+        for it, None if the TV didn't reply or rejected it. Inputs are given
+        by name. The queries are sent without waiting for the replies in
+        between, while holding the port the whole time. If the TV is off or
+        doesn't reply to powerstatus, that's the only one in the dict.
+
+        Hooks get a 'command' event for 'snapshot'.
+        '''
+        self.start_timing()
+        self.deadline = self.call_deadline()
+        try:
+            self.connect()
+            with self.port_lock() as lock:
+                self.emit('lock_wait', 'snapshot', {'lock': 'port', 'wait': lock.wait})
+                self.mark('lock')
+                return self.snapshot_locked(timeout)
+        finally:
+            self.deadline = None
+            if not self.keep_open:
+                self.disconnect()
+            self.finish_timing('snapshot')
+
+    def snapshot_locked(self, timeout):
+        commands = self.status_commands()
+        results = {}
+        if 'powerstatus' in self.codes:
+            commands.remove('powerstatus')
+            results = self.query_pipelined(self.pipeline_rounds(['powerstatus'])[0], timeout)
+            if not results['powerstatus']:
+                # Everything else is rejected while it's off
+                return results
+        for pending in self.pipeline_rounds(commands):
+            results.update(self.query_pipelined(pending, timeout))
+        return results
+
+    def probe_baudrate(self, candidates=None, timeout=0.3, refresh=False):
+        '''Finds the fastest baud rate in candidates (probe_baudrates by
+        default) that the TV replies to powerstatus at and uses it from then
+        on. The rate is remembered for the serial device until the next time
+        the computer starts, so later calls use it without probing unless
+        refresh is True. Returns the rate or None if the TV didn't reply at
+        any of them, in which case the baud rate isn't changed.
+        '''
+        if candidates is None:
+            candidates = probe_baudrates
+        rate = None if refresh else self.cached_baudrate(candidates)
+        if rate is None:
+            rate = self.probe_baudrates(candidates, timeout)
+            if rate is None:
+                return None
+            self.use_baudrate(rate, remember=True)
+        else:
+            self.use_baudrate(rate)
+        return rate
+
+    # Anyone can write to the file, so only one of candidates is used from it
+    def cached_baudrate(self, candidates):
+        try:
+            rate = int(read_shared(device_path(self.port, '.baud')) or '')
+        except ValueError:
+            return None
+        return rate if rate in candidates else None
+
+    def use_baudrate(self, rate, remember=False):
+        if remember:
+            path = device_path(self.port, '.baud')
+            with os.fdopen(open_shared(path, os.O_WRONLY | os.O_TRUNC), 'w') as f:
+                f.write(str(rate))
+        for opener in (self, self.bus):
+            if opener is not None:
+                opener.serial_settings['baudrate'] = rate
+
+    # Opens the port at rate, returns False if the adapter doesn't support it
+    def open_at(self, rate):
+        import serial
+        self.serial_settings['baudrate'] = rate
+        try:
+            self.connection = self.get_port()
+        except (ValueError, serial.serialutil.SerialException):
+            return False
+        # Only a reply sets it to something else
+        self.last_result = None
+        return True
+
+    # An NG still means the TV understood it
+    def replied(self):
+        return self.last_result in ('ok', 'ng')
+
+    def probe_baudrates(self, candidates, timeout):
+        code = self.address(self.codes['powerstatus'])
+        baudrate = self.serial_settings['baudrate']
+        self.disconnect()
+        try:
+            for rate in candidates:
+                if not self.open_at(rate):
+                    continue
+                try:
+                    with self.port_lock():
+                        self.query_full(code, timeout)
+                finally:
+                    self.disconnect()
+                if self.replied():
+                    return rate
+        finally:
+            self.serial_settings['baudrate'] = baudrate
+        return None
+
+    def add_hook(self, hook):
+        '''Call hook(event, command, info) when something happens:
+
+        - 'command' after every send(). info has 'result', which is 'ok', 'ng',
+          'timeout', 'cached' or 'error' if an exception was raised. It also
+          has the seconds since send() was called when the port was open
+          ('port_open'), the port was locked ('lock'), the command was written ('write'), the first byte of
+          the reply arrived ('first_byte'), the reply was complete ('reply')
+          and send() was done ('total'). Commands that query the TV twice, like
+          toggles, have the times of the last query.
+        - 'reopen' when the port had to be reopened in the middle of send()
+        - 'open_retry' when opening the port failed and is going to be retried
+        - 'retry' when a command is going to be sent again, see
+          command_retry. info has the 'result' of the last try.
+        - 'device_added' and 'device_removed' when the serial device comes or
+          goes, see device_changed().
+        - 'lock_wait' when the lock for the serial device was taken, info has
+          'lock', which is 'port', and the seconds it took as 'wait'.
+
+        See metrics.CommandMetrics for a hook that collects all of these.
+        '''
+        self.hooks.append(hook)
+
+    def emit(self, event, command=None, info=None):
+        for hook in self.hooks:
+            hook(event, command, {} if info is None else info)
+
+    def start_timing(self):
+        self.timing_start = time.perf_counter()
+        self.timing = {}
+        self.last_result = 'error'
+
+    def mark(self, name):
+        self.timing[name] = time.perf_counter() - self.timing_start
+
+    def finish_timing(self, command):
+        self.mark('total')
+        if self.hooks:
+            self.emit('command', command, dict(self.timing, result=self.last_result))
+
+    def decode_response(self, command, response):
         if isinstance(response, bytes):
             response = self.data_to_int(response)
             if command == 'inputstatus':
@@ -310,11 +939,128 @@ class LGTV:
             else:
                 print("{0} : {1}".format(command, code))
 
+    def ramp_values(self, current, target, delta, max_steps, maximum=0xfe):
+        if target is None:
+            target = current + delta
+        target = min(max(target, 0), maximum)
+        distance = target - current
+        steps = min(max_steps, abs(distance))
+        return [current + round(distance * i / steps) for i in range(1, steps + 1)]
+
+    def ramp(self, command, target=None, delta=None, max_steps=5, interval=0.1):
+        '''Smoothly change a level like 'volumelevel' to target, or by delta
+        if target is None, using at most max_steps writes at least interval
+        seconds apart. Returns None if the TV rejected a command.
+        '''
+        if not command.endswith('level'):
+            raise ValueError(f'{command} is not a level')
+        keep_open = self.keep_open
+        self.keep_open = True
+        try:
+            current = self.send(command)
+            if current is None:
+                return None
+            for i, value in enumerate(self.ramp_values(current, target, delta, max_steps,
+                    self.level_maximum(self.codes[command]))):
+                if i:
+                    time.sleep(interval)
+                if self.send(command, value) is None:
+                    return None
+        finally:
+            self.keep_open = keep_open
+            if not keep_open:
+                self.disconnect()
+        return True
+
     def add_toggle(self, command, state0, state1):
         self.toggles['toggle' + command] = (state0, state1)
 
-    def debounce(self, command, wait_secs=0.5):
-        self.debounces[command] = wait_secs
+    # Suppress command for wait_secs seconds after it was sent, on the leading
+    # edge, or until it hasn't been sent for wait_secs seconds and then send
+    # the last one, on the trailing edge. send() returns SUPPRESSED right away
+    # for commands that aren't sent then.
+    def debounce(self, command, wait_secs=0.5, edge=LEADING):
+        self.limits[command] = Debounce(wait_secs, edge)
+
+    # Suppress command beyond rate a second on average, allowing up to burst at
+    # once.
+    def rate_limit(self, command, rate, burst=1):
+        self.limits[command] = TokenBucket(rate, burst)
+
+    def set_timeout(self, command, secs):
+        self.timeouts[command] = secs
+
+    # Remember the state reported by the TV for ttl seconds and use it instead
+    # of asking again for toggles, up/down and status commands. Only use this
+    # if nothing else, like the remote, is changing the TV's state or if ttl
+    # is short enough that doesn't matter.
+    def enable_cache(self, ttl=2.0):
+        self.cache_ttl = ttl
+
+    def disable_cache(self):
+        self.cache_ttl = None
+        self.clear_cache()
+
+
+# Parses a batch step like 'volumelevel 12', 'volumelevel=12' or 'sleep 0.5'
+# into (command, data). For sleep the data is the seconds to sleep.
+def parse_step(text):
+    parts = text.replace('=', ' ').split()
+    if len(parts) not in (1, 2):
+        raise ValueError(f'bad command {text!r}')
+    command = parts[0]
+    if len(parts) == 1:
+        return command, None
+    return command, float(parts[1]) if command == 'sleep' else int(parts[1])
+
+
+def send_batch(tv, steps, use_broker=True, delay=0, keep_going=False):
+    '''Send each (command, data) in steps in order over one connection, to the
+    broker if there's one and use_broker is True or to the serial device
+    otherwise. ('sleep', seconds) waits, and delay is slept between commands.
+
+    Yields (command, data, response, seconds it took, exception or None) for
+    each command. Stops after the first one that fails, unless keep_going is
+    True.
+    '''
+    client = None
+    if use_broker:
+        from .broker_client import BrokerClient
+        try:
+            client = BrokerClient(tv.port).connect()
+        except OSError:
+            pass
+    if client is None:
+        keep_open = tv.keep_open
+        tv.open()
+    try:
+        first = True
+        for command, data in steps:
+            if command == 'sleep':
+                time.sleep(data)
+                continue
+            if delay and not first:
+                time.sleep(delay)
+            first = False
+            start = time.perf_counter()
+            response = error = None
+            try:
+                if client is None:
+                    response = tv.send(command, data)
+                elif tv.suppress(command, data):
+                    response = SUPPRESSED
+                else:
+                    response = client.send(tv.model, tv.set_id, command, data)
+            except Exception as e:
+                error = e
+            yield command, data, response, time.perf_counter() - start, error
+            if (response is None or error is not None) and not keep_going:
+                break
+    finally:
+        if client is not None:
+            client.close()
+        elif not keep_open:
+            tv.close()
 
 
 def main():
@@ -322,27 +1068,117 @@ def main():
     parser = ArgumentParser()
     parser.add_argument('model', metavar='MODEL')
     parser.add_argument('-s', '--serial', metavar='SERIAL_DEVICE', default=LGTV.default_serial)
+    parser.add_argument('-i', '--set-id', metavar='SET_ID', type=int, default=0)
     action = parser.add_mutually_exclusive_group()
     action.add_argument('-l', '--list-commands', action='store_true')
-    action.add_argument('-c', '--command', metavar='COMMAND')
-    parser.add_argument('-d', '--data', metavar='DATA')
+    action.add_argument('-c', '--command', metavar='COMMAND', action='append',
+        help='Can be given more than once to send several commands in order. '
+            'Data can be given with each, like volumelevel=12')
+    action.add_argument('--script', metavar='FILE',
+        help='Send the commands in FILE, - for stdin, one per line like '
+            '"volumelevel 12" or "sleep SECONDS"')
+    parser.add_argument('-d', '--data', metavar='DATA', type=int,
+        help='Data for a single --command')
+    parser.add_argument('--delay', metavar='SECONDS', type=float, default=0,
+        help='Wait this long between commands')
+    parser.add_argument('-k', '--keep-going', action='store_true',
+        help='Send the rest of the commands after one fails')
+    parser.add_argument('--json', action='store_true',
+        help='Print a JSON object for each command with the response and latency')
+    parser.add_argument('--debounce', metavar='SECONDS', type=float,
+        help='Suppress the commands if they were sent in the last SECONDS, '
+            'even by another process')
+    parser.add_argument('--trailing', action='store_true',
+        help='With --debounce, send the last of the commands once none were '
+            'sent for SECONDS instead of the first')
+    parser.add_argument('--rate', metavar='PER_SECOND', type=float,
+        help='Suppress the commands if they were sent more than PER_SECOND '
+            'times a second on average, even by another process')
+    parser.add_argument('--burst', metavar='COUNT', type=int, default=1,
+        help='How many of the commands --rate lets through at once')
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--no-broker', action='store_true',
+        help='Always use the serial device directly, even if a broker is running')
+    parser.add_argument('-b', '--baudrate', metavar='RATE',
+        help=f'Baud rate of the serial device (default: {default_serial_settings["baudrate"]}), '
+            'or "auto" to find the fastest one that works')
+    parser.add_argument('--record', metavar='FILE',
+        help='Append everything sent to and received from the TV to FILE')
+    parser.add_argument('--replay', metavar='FILE',
+        help='Pretend to be talking to the TV recorded in FILE using --record')
     args = parser.parse_args()
 
-    tv = LGTV(args.model, args.serial, args.verbose)
+    tv = LGTV(args.model, args.serial, args.verbose, args.set_id)
+    if args.baudrate == 'auto':
+        if tv.probe_baudrate() is None:
+            sys.exit('TV did not reply at any baud rate')
+    elif args.baudrate is not None:
+        tv.serial_settings['baudrate'] = int(args.baudrate)
+    if args.record is not None:
+        from .recorder import Recorder
+        tv.recorder = Recorder(args.record)
+    if args.replay is not None:
+        from .recorder import Replay
+        tv.transport = Replay(args.replay).open
     if args.list_commands:
         tv.available_commands()
-    elif args.command:
-        data = args.data
-        if data is not None:
-            data = int(data)
-        response = tv.send(args.command, data)
-        if isinstance(response, int):
-            print(hex(response))
+        return
+
+    if args.command:
+        if args.data is not None and len(args.command) > 1:
+            parser.error('--data can only be used with a single --command')
+        steps = [parse_step(text) for text in args.command]
+        if args.data is not None:
+            steps[0] = (steps[0][0], args.data)
+    elif args.script:
+        if args.script == '-':
+            lines = sys.stdin.readlines()
         else:
-            print(response)
-        if response is None:
-            sys.exit('TV rejected the command')
+            with open(args.script) as f:
+                lines = f.readlines()
+        steps = [parse_step(line) for line in lines
+            if line.strip() and not line.lstrip().startswith('#')]
+    else:
+        return
+    for command in {command for command, data in steps if command != 'sleep'}:
+        if args.rate is not None:
+            tv.rate_limit(command, args.rate, args.burst)
+        elif args.debounce is not None:
+            tv.debounce(command, args.debounce, TRAILING if args.trailing else LEADING)
+
+    if args.json:
+        import json
+    batch = len(steps) > 1
+    failed = 0
+    for command, data, response, seconds, error in send_batch(tv, steps,
+            use_broker=not (args.no_broker or args.verbose or args.record or args.replay
+                or args.baudrate),
+            delay=args.delay,
+            keep_going=args.keep_going):
+        if error is not None and not args.json and not batch:
+            raise error
+        ok = error is None and response is not None
+        failed += not ok
+        suppressed = response is SUPPRESSED
+        if args.json:
+            print(json.dumps({
+                'command': command,
+                'data': data,
+                'response': None if suppressed else response,
+                'suppressed': suppressed,
+                'ok': ok,
+                'latency_ms': round(seconds * 1000, 3),
+                'error': None if error is None else f'{type(error).__name__}: {error}',
+            }), flush=True)
+            continue
+        text = hex(response) if isinstance(response, int) else str(response)
+        if suppressed:
+            text = 'suppressed'
+        if error is not None:
+            text = f'{type(error).__name__}: {error}'
+        print(f'{command}: {text}' if batch else text, flush=True)
+    if failed:
+        sys.exit('TV rejected the command' if not batch else f'{failed} command(s) failed')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,355 @@
+import time
+import asyncio
+
+import serial
+
+from . import (LGTV, LGTVTimeoutError, SUPPRESSED, frame_terminator, max_frame_len,
+    probe_baudrates, take_pending)
+from .filelock import FileLockException
+
+
+class AsyncLGTV(LGTV):
+    '''asyncio version of LGTV. It uses the same code tables, toggles and
+    up/down commands, but send() is a coroutine and waiting on the TV doesn't
+    block the event loop. Many TVs can be awaited at once using
+    asyncio.gather(). This relies on the event loop being able to watch the
+    serial device's file descriptor, so it won't work on Windows.
+    '''
+
+    def __init__(self, model, port=None, verbose=False, set_id=0):
+        super().__init__(model, port, verbose, set_id)
+        # Only one transaction at a time can be on the wire
+        self.lock = asyncio.Lock()
+        # What was read past the end of the last frame
+        self.read_buffer = b''
+        # Tasks sending trailing edge commands, see send_later()
+        self.later = set()
+
+    def get_port(self):
+        ser = super().get_port()
+        # Reads only ever take what's already there, waiting is done by
+        # wait_readable().
+        ser.timeout = 0
+        return ser
+
+    async def get_port_ensured(self):
+        retries = self.open_retry.delays(self.deadline)
+        while True:
+            try:
+                return self.get_port()
+            except serial.serialutil.SerialException as e:
+                delay = next(retries, None)
+                if delay is None:
+                    raise LGTVTimeoutError(f'Could not open the serial device: {e}') from e
+                self.emit('open_retry')
+                await asyncio.sleep(delay)
+
+    async def connect(self, ensured=True):
+        if self.connection is None:
+            self.connection = await self.get_port_ensured() if ensured else self.get_port()
+        self.mark('port_open')
+        return self.connection
+
+    async def __aenter__(self):
+        return self.open()
+
+    async def __aexit__(self, type, value, traceback):
+        self.close()
+
+    def wait_readable(self):
+        loop = asyncio.get_running_loop()
+        fd = self.connection.fileno()
+        future = loop.create_future()
+
+        def ready():
+            if not future.done():
+                future.set_result(None)
+
+        loop.add_reader(fd, ready)
+        # Also stops watching when the wait is cancelled by a timeout
+        future.add_done_callback(lambda f: loop.remove_reader(fd))
+        return future
+
+    async def read_frame(self, code, timeout):
+        return await self.read_matching(lambda parsed: self.frame_matches(code, parsed), timeout)
+
+    # Like read_frame(), but returns the first frame match(parsed) is True for.
+    # Anything after it is kept for the next call.
+    async def read_matching(self, match, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        buf, self.read_buffer = self.read_buffer, b''
+        while True:
+            end = buf.find(frame_terminator)
+            while end >= 0:
+                frame, buf = buf[:end + 1], buf[end + 1:]
+                if self.verbose:
+                    print('Receive:', frame)
+                parsed = self.parse_frame(frame)
+                if parsed is not None and match(parsed):
+                    self.read_buffer = buf
+                    return parsed
+                end = buf.find(frame_terminator)
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self.wait_readable(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if 'first_byte' not in self.timing:
+                self.mark('first_byte')
+            buf = buf[-max_frame_len:] + self.connection.read(max_frame_len)
+        if self.verbose and buf:
+            print('Receive (incomplete):', buf)
+        return None
+
+    async def query_full(self, code, timeout=None):
+        timeout = self.reply_timeout(timeout)
+        if self.verbose:
+            print('Send:', code)
+        self.connection.reset_input_buffer()
+        self.read_buffer = b''
+        self.connection.write(code + b'\r')
+        self.mark('write')
+        parsed = await self.read_frame(code, timeout)
+        self.mark('reply')
+        self.update_cache(code, parsed)
+        if parsed is None:
+            self.last_result = 'timeout'
+        elif self.is_success(parsed):
+            self.last_result = 'ok'
+            return parsed
+        else:
+            self.last_result = 'ng'
+
+    async def query_data(self, code, timeout=None):
+        response = await self.query_full(code, timeout)
+        return response and response[3]
+
+    async def query_status(self, code, timeout=None):
+        data = self.cached_data(code)
+        if data is None:
+            data = await self.query_data(code, timeout)
+        else:
+            self.last_result = 'cached'
+        return data
+
+    async def lookup(self, command, data_arg):
+        status_code = self.lookup_status_code(command)
+        level = None if status_code is None else await self.query_status(status_code)
+        return self.lookup_with_level(command, data_arg, level)
+
+    async def query(self, command, data_arg):
+        command_seq = await self.lookup(command, data_arg)
+        if command_seq is None:
+            return None
+        timeout = self.timeout_for(command)
+        if not self.is_status(command):
+            return await self.query_full(command_seq, timeout) and True
+        elif data_arg is None:
+            return await self.query_status(command_seq, timeout)
+        else:
+            # Setting a level always goes to the TV, the reply updates the cache
+            return await self.query_data(command_seq, timeout)
+
+    async def increment(self, code):
+        return self.delta_level(code, await self.query_status(code), +1)
+
+    async def decrement(self, code):
+        return self.delta_level(code, await self.query_status(code), -1)
+
+    async def toggle(self, code, togglecommands):
+        return self.toggle_level(code, togglecommands, await self.query_status(code))
+
+    async def acquire_port_lock(self, command):
+        lock = self.port_lock()
+        lock.blocking = False
+        start = time.perf_counter()
+        try:
+            lock.acquire()
+        except FileLockException:
+            # Someone else is using the port, wait for it in a thread so the
+            # event loop isn't blocked.
+            lock.blocking = True
+            await asyncio.get_running_loop().run_in_executor(None, lock.acquire)
+        self.emit('lock_wait', command, {'lock': 'port', 'wait': time.perf_counter() - start})
+        self.mark('lock')
+        return lock
+
+    async def locked_query(self, command, data_arg):
+        lock = await self.acquire_port_lock(command)
+        try:
+            return await self.query(command, data_arg)
+        finally:
+            lock.release()
+
+    async def query_pipelined(self, pending, timeout=None):
+        if timeout is None:
+            timeout = max(self.timeout_for(command) for command, code in pending.values())
+        timeout = self.reply_timeout(timeout)
+        self.connection.reset_input_buffer()
+        self.read_buffer = b''
+        for command, code in pending.values():
+            if self.verbose:
+                print('Send:', code)
+            self.connection.write(code + b'\r')
+        self.mark('write')
+
+        results = dict.fromkeys(command for command, code in pending.values())
+        waiting = dict(pending)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        def match(parsed):
+            return parsed[0] in waiting and self.frame_matches(waiting[parsed[0]][1], parsed)
+
+        while waiting:
+            parsed = await self.read_matching(match, deadline - loop.time())
+            if parsed is None:
+                break
+            command, code = waiting.pop(parsed[0])
+            self.update_cache(code, parsed)
+            if self.is_success(parsed):
+                results[command] = self.decode_response(command, parsed[3])
+        self.mark('reply')
+        if waiting:
+            self.last_result = 'timeout'
+        elif None in results.values():
+            self.last_result = 'ng'
+        else:
+            self.last_result = 'ok'
+        return results
+
+    async def snapshot(self, timeout=None):
+        async with self.lock:
+            self.start_timing()
+            self.deadline = self.call_deadline()
+            try:
+                await self.connect()
+                lock = await self.acquire_port_lock('snapshot')
+                try:
+                    return await self.snapshot_locked(timeout)
+                finally:
+                    lock.release()
+            finally:
+                self.deadline = None
+                if not self.keep_open:
+                    self.disconnect()
+                self.finish_timing('snapshot')
+
+    async def snapshot_locked(self, timeout):
+        commands = self.status_commands()
+        results = {}
+        if 'powerstatus' in self.codes:
+            commands.remove('powerstatus')
+            results = await self.query_pipelined(self.pipeline_rounds(['powerstatus'])[0], timeout)
+            if not results['powerstatus']:
+                return results
+        for pending in self.pipeline_rounds(commands):
+            results.update(await self.query_pipelined(pending, timeout))
+        return results
+
+    async def send_once(self, command, data_arg):
+        await self.connect()
+        return await self.locked_query(command, data_arg)
+
+    # The copy shares self.lock, so it waits its turn.
+    def send_later(self, delay, command, data_arg, token):
+        tv = self.unlimited_copy()
+        key = self.limit_key(command)
+        async def send():
+            await asyncio.sleep(delay)
+            if take_pending(self.port, key, token):
+                await tv.send(command, data_arg)
+        task = asyncio.ensure_future(send())
+        self.later.add(task)
+        task.add_done_callback(self.later.discard)
+
+    async def probe_baudrate(self, candidates=None, timeout=0.3, refresh=False):
+        if candidates is None:
+            candidates = probe_baudrates
+        rate = None if refresh else self.cached_baudrate(candidates)
+        if rate is None:
+            rate = await self.probe_baudrates(candidates, timeout)
+            if rate is None:
+                return None
+            self.use_baudrate(rate, remember=True)
+        else:
+            self.use_baudrate(rate)
+        return rate
+
+    async def probe_baudrates(self, candidates, timeout):
+        code = self.address(self.codes['powerstatus'])
+        baudrate = self.serial_settings['baudrate']
+        self.disconnect()
+        try:
+            for rate in candidates:
+                if not self.open_at(rate):
+                    continue
+                try:
+                    lock = await self.acquire_port_lock('powerstatus')
+                    try:
+                        await self.query_full(code, timeout)
+                    finally:
+                        lock.release()
+                finally:
+                    self.disconnect()
+                if self.replied():
+                    return rate
+        finally:
+            self.serial_settings['baudrate'] = baudrate
+        return None
+
+    async def send_retrying(self, command, data_arg):
+        response = await self.send_once(command, data_arg)
+        if response is None and self.is_retryable(command):
+            for delay in self.command_retry.delays(self.deadline):
+                self.emit('retry', command, {'result': self.last_result})
+                await asyncio.sleep(delay)
+                response = await self.send_once(command, data_arg)
+                if response is not None:
+                    break
+        return response
+
+    async def send(self, command, data_arg=None):
+        if self.suppress(command, data_arg):
+            return SUPPRESSED
+        async with self.lock:
+            self.start_timing()
+            self.deadline = self.call_deadline()
+            try:
+                response = await self.send_retrying(command, data_arg)
+            except serial.serialutil.SerialException:
+                if not self.keep_open:
+                    raise
+                self.emit('reopen', command)
+                self.disconnect()
+                response = await self.send_retrying(command, data_arg)
+            finally:
+                self.deadline = None
+                if not self.keep_open:
+                    self.disconnect()
+                self.finish_timing(command)
+        return self.decode_response(command, response)
+
+    async def ramp(self, command, target=None, delta=None, max_steps=5, interval=0.1):
+        if not command.endswith('level'):
+            raise ValueError(f'{command} is not a level')
+        keep_open = self.keep_open
+        self.keep_open = True
+        try:
+            current = await self.send(command)
+            if current is None:
+                return None
+            for i, value in enumerate(self.ramp_values(current, target, delta, max_steps,
+                    self.level_maximum(self.codes[command]))):
+                if i:
+                    await asyncio.sleep(interval)
+                if await self.send(command, value) is None:
+                    return None
+        finally:
+            self.keep_open = keep_open
+            if not keep_open:
+                self.disconnect()
+        return True
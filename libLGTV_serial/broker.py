@@ -0,0 +1,109 @@
+import os
+import socket
+import threading
+import socketserver
+
+from . import LGTV, default_serial_settings
+from .bus import SharedPort
+from .broker_client import BrokerError, socket_path, decode_request, encode_reply
+
+
+class Broker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer, SharedPort):
+    '''Keeps a serial device open and runs commands for it sent over a Unix
+    domain socket, one at a time. The command line uses it automatically if
+    it's running, so it doesn't have to open the port itself every time.
+
+    See broker_client.py for the protocol.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, port, verbose=False):
+        # The socket server's __init__ doesn't call the next one
+        SharedPort.__init__(self, port)
+        self.verbose = verbose
+        # (model, set ID) -> LGTV, all sharing self.connection
+        self.tvs = {}
+        self.lock = threading.Lock()
+        path = socket_path(port)
+        remove_stale_socket(path)
+        super().__init__(path, BrokerHandler)
+
+    def tv(self, model, set_id):
+        key = (model.upper(), set_id)
+        tv = self.tvs.get(key)
+        if tv is None:
+            tv = LGTV(model, self.port, self.verbose, set_id).open()
+            tv.bus = self
+            self.tvs[key] = tv
+        return tv
+
+    def run(self, model, set_id, command, data):
+        with self.lock:
+            return self.tv(model, set_id).send(command, data)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+        for tv in self.tvs.values():
+            tv.close()
+        self.disconnect()
+
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = encode_reply(self.server.run(*decode_request(line)))
+            except Exception as e:
+                reply = encode_reply(error=f'{type(e).__name__}: {e}')
+            self.wfile.write(reply)
+
+
+def remove_stale_socket(path):
+    if not os.path.exists(path):
+        return
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+    else:
+        raise BrokerError(f'A broker is already running on {path}')
+    finally:
+        s.close()
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Keep serial devices open for the command line')
+    parser.add_argument('-s', '--serial', metavar='SERIAL_DEVICE', action='append',
+        help=f'Can be given more than once, the default is {LGTV.default_serial}')
+    parser.add_argument('-b', '--baudrate', metavar='RATE', type=int,
+        default=default_serial_settings['baudrate'])
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    brokers = [Broker(port, args.verbose) for port in args.serial or [LGTV.default_serial]]
+    for broker in brokers:
+        broker.serial_settings['baudrate'] = args.baudrate
+    threads = []
+    for broker in brokers:
+        print(f'Serving {broker.port} on {broker.server_address}', flush=True)
+        thread = threading.Thread(target=broker.serve_forever, daemon=True)
+        thread.start()
+        threads.append(thread)
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        pass
+    for broker in brokers:
+        broker.server_close()
+
+
+if __name__ == '__main__':
+    main()
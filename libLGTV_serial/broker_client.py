@@ -0,0 +1,111 @@
+# Kept apart from broker.py so the command line doesn't have to import
+# socketserver to talk to the broker. The protocol is simple enough to not need
+# json either, each request is a line like
+#
+#     42LK450 0 volumelevel 10
+#
+# with the model, set ID, command and optionally data. Each reply is a line
+# starting with a letter for the type of what LGTV.send() returned followed by
+# the value: N for None, T for True, I for an int, S for a str. E is an error
+# message.
+import os
+
+from .filelock import device_path
+
+
+class BrokerError(Exception):
+    pass
+
+
+def socket_path(port):
+    return device_path(port, '.sock')
+
+
+def encode_request(model, set_id, command, data=None):
+    parts = [model, str(set_id), command]
+    if data is not None:
+        parts.append(str(data))
+    return ' '.join(parts).encode() + b'\n'
+
+
+def decode_request(line):
+    parts = line.decode().split()
+    if len(parts) not in (3, 4):
+        raise ValueError(f'bad request {line!r}')
+    data = int(parts[3]) if len(parts) == 4 else None
+    return parts[0], int(parts[1]), parts[2], data
+
+
+def encode_reply(response=None, error=None):
+    if error is not None:
+        line = 'E' + error.replace('\n', ' ')
+    elif response is None:
+        line = 'N'
+    elif response is True:
+        line = 'T'
+    elif isinstance(response, int):
+        line = f'I{response}'
+    else:
+        line = f'S{response}'
+    return line.encode() + b'\n'
+
+
+def decode_reply(line):
+    kind, value = line[:1], line[1:].rstrip(b'\n').decode()
+    if kind == b'E':
+        raise BrokerError(value)
+    elif kind == b'N':
+        return None
+    elif kind == b'T':
+        return True
+    elif kind == b'I':
+        return int(value)
+    elif kind == b'S':
+        return value
+    raise BrokerError(f'bad reply {line!r}')
+
+
+class BrokerClient:
+    '''Sends commands to the Broker for a serial device. Raises OSError when
+    connecting if there isn't one running.
+    '''
+
+    def __init__(self, port):
+        self.path = socket_path(port)
+        self.socket = None
+        self.file = None
+
+    def connect(self):
+        if not os.path.exists(self.path):
+            # Don't bother importing socket
+            raise FileNotFoundError(f'No broker at {self.path}')
+        import socket
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.connect(self.path)
+        except OSError:
+            self.socket.close()
+            raise
+        self.file = self.socket.makefile('rwb')
+        return self
+
+    def close(self):
+        if self.socket is not None:
+            self.file.close()
+            self.socket.close()
+            self.socket = None
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    # Returns what LGTV.send() returned in the broker
+    def send(self, model, set_id, command, data=None):
+        self.file.write(encode_request(model, set_id, command, data))
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise BrokerError('Broker closed the connection')
+        return decode_reply(line)
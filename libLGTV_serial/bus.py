@@ -0,0 +1,129 @@
+import time
+
+from . import LGTV, RetryPolicy, default_serial_settings, open_port, read_raw_frame
+from .filelock import port_lock
+
+
+class SharedPort:
+    '''A serial port that several LGTV objects share by having it as their
+    bus, like LGTVBus and broker.Broker. The port is opened by the first
+    connect() and stays open until disconnect().
+    '''
+
+    def __init__(self, port):
+        self.port = port
+        self.connection = None
+        # See LGTV.open_retry, LGTV.serial_settings, LGTV.transport and
+        # LGTV.recorder
+        self.open_retry = RetryPolicy(timeout=10)
+        self.serial_settings = dict(default_serial_settings)
+        self.transport = None
+        self.recorder = None
+
+    get_port = LGTV.get_port
+
+    def port_lock(self):
+        return port_lock(self.port)
+
+    def get_port_ensured(self):
+        return open_port(self.get_port, self.open_retry)
+
+    def connect(self, ensured=True):
+        if self.connection is None or not self.connection.is_open:
+            self.connection = self.get_port_ensured() if ensured else self.get_port()
+        return self.connection
+
+    def disconnect(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class LGTVBus(SharedPort):
+    '''Several TVs daisy-chained on one serial port, each with its own set ID.
+
+    The TVs returned by add() are normal LGTV objects that share the bus's
+    serial port. poll() sends a status command to every TV on the bus at once
+    and sorts the replies out by the set ID in them.
+    '''
+
+    def __init__(self, port=None, verbose=False):
+        super().__init__(port if port is not None else LGTV.default_serial)
+        self.verbose = verbose
+        self.tvs = {}
+        self.keep_open = False
+
+    def add(self, model, set_id):
+        if set_id == 0:
+            raise ValueError('TVs on a bus need their own set ID, not 0')
+        if set_id in self.tvs:
+            raise ValueError(f'set ID {set_id} is already on the bus')
+        tv = LGTV(model, self.port, self.verbose, set_id)
+        tv.bus = self
+        self.tvs[set_id] = tv
+        return tv
+
+    # Keep the port open for poll() and all the TVs, see LGTV.open()
+    def open(self):
+        self.keep_open = True
+        for tv in self.tvs.values():
+            tv.open()
+        return self
+
+    def close(self):
+        self.keep_open = False
+        for tv in self.tvs.values():
+            tv.close()
+        self.disconnect()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def poll(self, command, timeout=None):
+        '''Send a status command like 'powerstatus' to every TV without waiting
+        for replies in between. Returns a dict of set ID to what LGTV.send
+        would have returned for that TV, None for TVs that didn't reply in time.
+        '''
+        if not LGTV.is_status(command):
+            raise ValueError(f'{command} is not a status command')
+        connection = self.connect()
+        with self.port_lock():
+            results = self.poll_locked(connection, command, timeout)
+        if not self.keep_open:
+            self.disconnect()
+        return results
+
+    def poll_locked(self, connection, command, timeout):
+        connection.reset_input_buffer()
+        waiting = {}
+        for set_id, tv in self.tvs.items():
+            code = tv.lookup(command, None)
+            if tv.verbose:
+                print('Send:', code)
+            connection.write(code + b'\r')
+            waiting[f'{set_id:02x}'.encode()] = (tv, code)
+        results = dict.fromkeys(self.tvs)
+
+        if timeout is None:
+            timeout = max(tv.timeout_for(command) for tv in self.tvs.values())
+        deadline = time.monotonic() + timeout
+        while waiting:
+            frame = read_raw_frame(connection, deadline)
+            if frame is None:
+                break
+            if self.verbose:
+                print('Receive:', frame)
+            parsed = LGTV.parse_frame(frame)
+            if parsed is None or parsed[1] not in waiting:
+                continue
+            tv, code = waiting[parsed[1]]
+            if not tv.frame_matches(code, parsed):
+                continue
+            del waiting[parsed[1]]
+            tv.update_cache(code, parsed)
+            if tv.is_success(parsed):
+                results[tv.set_id] = tv.decode_response(command, parsed[3])
+        return results
@@ -2,54 +2,118 @@ import os
 import time
 import errno
 
+O_NOFOLLOW = getattr(os, 'O_NOFOLLOW', 0)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
 class FileLockException(Exception):
     pass
 
 class FileLock(object):
     """ A file locking mechanism that has context-manager support so
-        you can use it in a with statement. This should be relatively cross
-        compatible as it doesn't rely on msvcrt or fcntl for the locking.
+        you can use it in a with statement. It uses the locking the OS
+        provides (flock on Unix, msvcrt on Windows), so waiting on the lock
+        without a timeout doesn't poll and the lock goes away when the process
+        holding it dies, even if the lock file is left behind.
     """
 
-    def __init__(self, file_name, timeout=10, delay=.05):
-        """ Prepare the file locker. Specify the file to lock and optionally
-            the maximum timeout and the delay between each attempt to lock.
+    def __init__(self, file_name, timeout=None, delay=.05, blocking=True):
+        """ Prepare the file locker. Specify the file to lock and if acquiring
+            it should wait for it to be released or raise FileLockException
+            right away if it's held by someone else. When waiting, timeout is
+            the most seconds to wait before raising FileLockException (None
+            waits as long as it takes) and delay the longest time between
+            attempts.
         """
         self.is_locked = False
         self.lockfile = os.path.join(os.getcwd(), "%s.lock" % file_name)
         self.file_name = file_name
         self.timeout = timeout
         self.delay = delay
+        self.blocking = blocking
+        self.fd = None
+        # Seconds the last acquire() waited for the lock
+        self.wait = 0
 
 
     def acquire(self):
-        """ Acquire the lock, if possible. If the lock is in use, it check again
-            every `wait` seconds. It does this until it either gets the lock or
-            exceeds `timeout` number of seconds, in which case it throws
-            an exception.
+        """ Acquire the lock, waiting for it if blocking is True. If it's not
+            and the lock is held, or it wasn't released within timeout,
+            FileLockException is raised.
         """
-        start_time = time.time()
-        while True:
-            try:
-                self.fd = os.open(self.lockfile, os.O_CREAT|os.O_EXCL|os.O_RDWR)
-                break;
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    raise
-                if (time.time() - start_time) >= self.timeout:
-                    raise FileLockException("Timeout occured.")
-                time.sleep(self.delay)
+        start_time = time.perf_counter()
+        try:
+            # Only the one who made the file can write to it, nobody needs to
+            fd = open_shared(self.lockfile, os.O_RDWR, 0o644)
+        except PermissionError:
+            # flock works on files opened read-only too
+            fd = os.open(self.lockfile, os.O_RDONLY | O_NOFOLLOW)
+        try:
+            if self.blocking and self.timeout is None:
+                self._lock(fd)
+            elif not self._try_lock(fd):
+                if not self.blocking:
+                    raise FileLockException("Lock is held by someone else.")
+                wait = 0.001
+                while True:
+                    left = self.timeout - (time.perf_counter() - start_time)
+                    if left <= 0:
+                        raise FileLockException("Timeout occured.")
+                    time.sleep(min(wait, self.delay, left))
+                    wait *= 2
+                    if self._try_lock(fd):
+                        break
+        except BaseException:
+            os.close(fd)
+            raise
+        self.fd = fd
+        self.wait = time.perf_counter() - start_time
         self.is_locked = True
 
 
+    def _try_lock(self, fd):
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES, errno.EDEADLOCK):
+                return False
+            raise
+        return True
+
+
+    def _lock(self, fd):
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            # LK_LOCK gives up after trying for 10 seconds
+            while True:
+                try:
+                    msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError as e:
+                    if e.errno != errno.EDEADLOCK:
+                        raise
+
+
     def release(self):
-        """ Get rid of the lock by deleting the lockfile.
-            When working in a `with` statement, this gets automatically
-            called at the end.
+        """ Release the lock. The lock file is left in place, removing it could
+            let someone lock a new file while someone else is waiting on the
+            old one. When working in a `with` statement, this gets
+            automatically called at the end.
         """
         if self.is_locked:
+            if fcntl is None:
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
             os.close(self.fd)
-            os.unlink(self.lockfile)
+            self.fd = None
             self.is_locked = False
 
 
@@ -71,7 +135,71 @@ class FileLock(object):
 
 
     def __del__(self):
-        """ Make sure that the FileLock instance doesn't leave a lockfile
-            lying around.
+        """ Make sure that the FileLock instance doesn't keep the lock.
         """
         self.release()
+
+
+def temp_dir():
+    """ Same as tempfile.gettempdir() in practice, but importing tempfile is
+        slow enough to notice on the command line.
+    """
+    for name in ('TMPDIR', 'TEMP', 'TMP'):
+        if os.environ.get(name):
+            return os.environ[name]
+    if os.name == 'posix':
+        return '/tmp'
+    import tempfile
+    return tempfile.gettempdir()
+
+
+def device_path(port, suffix=''):
+    """ Returns a path in the temporary directory for a serial device, the same
+        for every path to the device, like /dev/serial/by-id symlinks.
+    """
+    name = ''.join(c if c.isalnum() or c in '._-' else '_'
+        for c in os.path.realpath(port).strip(os.sep))
+    return os.path.join(temp_dir(), '.lgtv-' + name + suffix)
+
+
+def open_shared(path, flags, mode=0o666):
+    """ os.open() for files that everyone using a serial device shares, like
+        the command line run by a user and a daemon run by root. If the file
+        has to be created, it gets mode whatever the umask is. O_CREAT is only
+        used if it doesn't exist, since with fs.protected_regular it can't be
+        used on someone else's file in /tmp. Symlinks aren't followed, so
+        nobody can point one at a file of whoever opens it.
+    """
+    flags |= O_NOFOLLOW
+    try:
+        return os.open(path, flags)
+    except FileNotFoundError:
+        pass
+    fd = os.open(path, flags | os.O_CREAT, mode)
+    if hasattr(os, 'fchmod'):
+        try:
+            os.fchmod(fd, mode)
+        except OSError:
+            pass # Someone else's file
+    return fd
+
+
+def read_shared(path, max_size=65536):
+    """ Returns what's in a file opened with open_shared() or None if it can't
+        be read.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | O_NOFOLLOW)
+    except OSError:
+        return None
+    with os.fdopen(fd) as f:
+        try:
+            return f.read(max_size)
+        except (OSError, ValueError):
+            return None
+
+
+def port_lock(port, blocking=True, timeout=None):
+    """ Returns a FileLock for a serial device.
+    """
+    return FileLock(device_path(port), timeout, blocking=blocking)
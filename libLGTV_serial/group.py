@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from . import LGTVTimeoutError
+
+
+class TVGroup:
+    '''Many TVs, usually on different serial devices, that commands are sent
+    to at once. Each serial device gets its own thread, up to max_workers at a
+    time, and TVs sharing one take turns.
+
+        group = TVGroup([LGTV('42LK450', '/dev/ttyUSB0'), LGTV('55C3PUA', '/dev/ttyUSB1')])
+        results, errors = group.send('inputhdmi1', timeout=5)
+
+    results and errors are dicts keyed by the TVs. poweron and togglepower
+    are started power_on_stagger seconds apart from one TV to the next, so
+    the TVs don't all draw their inrush current at the same moment.
+    '''
+
+    def __init__(self, tvs=(), max_workers=8, power_on_stagger=0):
+        self.tvs = list(tvs)
+        self.max_workers = max_workers
+        self.power_on_stagger = power_on_stagger
+        # TV -> lock held while calling something for it, so a call that
+        # timed out in one run() doesn't overlap with the next one.
+        self.locks = {}
+
+    def add(self, tv):
+        self.tvs.append(tv)
+        return tv
+
+    def run(self, func, timeout=None, stagger=0):
+        '''Calls func(tv) for every TV, starting each one stagger seconds
+        after the one before it. Returns (results, errors), where results has
+        what func returned for each TV and errors has what it raised. TVs that
+        weren't done within timeout seconds get an LGTVTimeoutError. Their
+        call keeps going in the background, but sending and snapshots give up
+        at the timeout too, see LGTV.outer_deadline. A TV still busy with a
+        call from an earlier run() is waited for.
+        '''
+        results = {}
+        errors = {}
+        lock = threading.Lock()
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+
+        def run_device(entries):
+            for start_at, tv in entries:
+                delay = start_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                tv_lock = self.locks[tv]
+                if not tv_lock.acquire(
+                        timeout=-1 if deadline is None else max(deadline - time.monotonic(), 0)):
+                    with lock:
+                        errors[tv] = LGTVTimeoutError(f'{tv.model} on {tv.port} is still busy')
+                    continue
+                try:
+                    tv.outer_deadline = deadline
+                    result = func(tv)
+                except Exception as e:
+                    with lock:
+                        errors[tv] = e
+                else:
+                    with lock:
+                        results[tv] = result
+                finally:
+                    tv.outer_deadline = None
+                    tv_lock.release()
+
+        by_device = {}
+        for i, tv in enumerate(self.tvs):
+            self.locks.setdefault(tv, threading.Lock())
+            by_device.setdefault(os.path.realpath(tv.port), []).append((start + i * stagger, tv))
+        if not by_device:
+            return {}, {}
+
+        executor = ThreadPoolExecutor(min(self.max_workers, len(by_device)))
+        futures = [executor.submit(run_device, entries) for entries in by_device.values()]
+        wait(futures, timeout)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        with lock:
+            results = dict(results)
+            errors = dict(errors)
+        for tv in self.tvs:
+            if tv not in results and tv not in errors:
+                errors[tv] = LGTVTimeoutError(f'{tv.model} on {tv.port} did not finish in time')
+        return results, errors
+
+    def send(self, command, data_arg=None, timeout=None, stagger=None):
+        '''LGTV.send() for every TV, see run().'''
+        if stagger is None:
+            stagger = self.power_on_stagger if command in ('poweron', 'togglepower') else 0
+        return self.run(lambda tv: tv.send(command, data_arg), timeout, stagger)
+
+    def snapshot(self, timeout=None):
+        '''LGTV.snapshot() for every TV, see run().'''
+        return self.run(lambda tv: tv.snapshot(), timeout)
@@ -0,0 +1,155 @@
+import os
+import select
+import threading
+import time
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x004
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+watch_mask = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+
+def load_inotify():
+    '''Returns libc if it has inotify, which is on Linux, or None.'''
+    if not hasattr(select, 'poll') or not os.path.isdir('/proc'):
+        return None
+    import ctypes
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def parent_dirs(port):
+    '''The directories that have to be watched to see port come and go, like
+    /dev, /dev/serial and /dev/serial/by-id for a /dev/serial/by-id symlink.
+    '''
+    dirs = []
+    path = os.path.dirname(os.path.abspath(port))
+    while True:
+        dirs.append(path)
+        parent = os.path.dirname(path)
+        if parent == path or path == '/dev':
+            break
+        path = parent
+    return dirs
+
+
+class DeviceWatcher:
+    '''Calls callback(present) from its own thread when a serial device
+    appears or disappears, like when a USB adapter is plugged in or out.
+
+        watcher = DeviceWatcher()
+        watcher.watch(tv.port, tv.device_changed)
+        watcher.start()
+
+    On Linux this waits on inotify for changes to the directories the device
+    is in, so it notices right away. It also checks every poll_interval
+    seconds, which is all it can do elsewhere. Symlinks like the ones in
+    /dev/serial/by-id count as present if what they point to exists.
+    '''
+
+    def __init__(self, poll_interval=2.0):
+        self.poll_interval = poll_interval
+        # port -> [callbacks, present]
+        self.watches = {}
+        self.lock = threading.Lock()
+        self.libc = None
+        self.fd = None
+        self.thread = None
+        self.running = False
+
+    @staticmethod
+    def is_present(port):
+        return os.path.exists(port)
+
+    def watch(self, port, callback):
+        '''Starts watching port, returns if it's there right now.'''
+        with self.lock:
+            watch = self.watches.setdefault(port, [[], self.is_present(port)])
+            watch[0].append(callback)
+            present = watch[1]
+        self.add_inotify_watches()
+        return present
+
+    def add_inotify_watches(self):
+        # Adding a watch for a directory again does nothing, so this is also
+        # used to start watching directories like /dev/serial/by-id that
+        # didn't exist before.
+        if self.fd is None:
+            return
+        with self.lock:
+            ports = list(self.watches)
+        for port in ports:
+            for path in parent_dirs(port):
+                if os.path.isdir(path):
+                    self.libc.inotify_add_watch(self.fd, os.fsencode(path), watch_mask)
+
+    def check(self):
+        '''Calls the callbacks for every device that came or went since the
+        last check.
+        '''
+        changed = []
+        with self.lock:
+            for port, watch in self.watches.items():
+                present = self.is_present(port)
+                if present != watch[1]:
+                    watch[1] = present
+                    changed.append((list(watch[0]), present))
+        for callbacks, present in changed:
+            for callback in callbacks:
+                callback(present)
+
+    def start(self):
+        self.libc = load_inotify()
+        if self.libc is not None:
+            fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            self.fd = fd if fd >= 0 else None
+        self.add_inotify_watches()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='DeviceWatcher', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def run(self):
+        poller = None
+        if self.fd is not None:
+            poller = select.poll()
+            poller.register(self.fd, select.POLLIN)
+        while self.running:
+            if poller is None:
+                time.sleep(self.poll_interval)
+            elif poller.poll(self.poll_interval * 1000):
+                try:
+                    # What changed doesn't matter, everything is checked
+                    while os.read(self.fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                self.add_inotify_watches()
+            self.check()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
@@ -0,0 +1,90 @@
+import bisect
+import threading
+
+
+class Histogram:
+    '''Counts of values in fixed buckets, bounds are the upper bounds of all
+    but the last bucket, which catches everything larger.
+    '''
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.count = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        return {
+            'buckets': {str(b): c for b, c in zip(self.bounds + ['inf'], self.counts)},
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'max': self.max,
+        }
+
+
+class CommandMetrics:
+    '''A hook for LGTV.add_hook() that collects latency histograms (in
+    milliseconds) for each command and each phase of sending it, counts
+    results like timeouts and NG replies, reopens of the port and the time
+    spent waiting on locks.
+
+        metrics = CommandMetrics()
+        tv.add_hook(metrics)
+        ...
+        print(json.dumps(metrics.snapshot()))
+    '''
+
+    phases = ('port_open', 'lock', 'write', 'first_byte', 'reply', 'total')
+    bounds_ms = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # command -> phase -> Histogram
+            self.latency = {}
+            # command -> result -> count
+            self.results = {}
+            self.events = {'reopen': 0, 'open_retry': 0, 'retry': 0}
+            # lock kind -> Histogram
+            self.lock_wait = {}
+
+    def __call__(self, event, command, info):
+        with self.lock:
+            if event == 'command':
+                latency = self.latency.setdefault(command, {})
+                for phase in self.phases:
+                    if phase in info:
+                        if phase not in latency:
+                            latency[phase] = Histogram(self.bounds_ms)
+                        latency[phase].add(info[phase] * 1000)
+                results = self.results.setdefault(command, {})
+                results[info['result']] = results.get(info['result'], 0) + 1
+            elif event == 'lock_wait':
+                if info['lock'] not in self.lock_wait:
+                    self.lock_wait[info['lock']] = Histogram(self.bounds_ms)
+                self.lock_wait[info['lock']].add(info['wait'] * 1000)
+            else:
+                self.events[event] = self.events.get(event, 0) + 1
+
+    def snapshot(self):
+        '''Returns everything collected so far as something that can be
+        converted to JSON.
+        '''
+        with self.lock:
+            return {
+                'latency_ms': {command: {phase: h.to_dict() for phase, h in phases.items()}
+                    for command, phases in self.latency.items()},
+                'results': {command: dict(results) for command, results in self.results.items()},
+                'events': dict(self.events),
+                'lock_wait_ms': {lock: h.to_dict() for lock, h in self.lock_wait.items()},
+            }
@@ -0,0 +1,195 @@
+import time
+from collections import deque
+
+from .ratelimit import SUPPRESSED
+
+OFF = 'off'
+WARMING = 'warming'
+ON = 'on'
+COOLING = 'cooling'
+
+
+class Buffered:
+    def __repr__(self):
+        return 'BUFFERED'
+
+
+# Returned by PowerStateMachine.send() for commands held back until the TV can
+# take them.
+BUFFERED = Buffered()
+
+
+class PowerStateMachine:
+    '''Keeps track of a TV being off, warming up, on or cooling down, so
+    commands can be sent as soon as the TV takes them instead of failing.
+
+    After poweron a TV acks power commands right away, but rejects anything
+    else until it has finished starting, which can take several seconds. While
+    it's warming up, send() holds back everything except power commands and
+    step() sends ready_command every poll_interval seconds. Once the TV
+    replies to it, the held back commands are sent in order. The same goes for
+    a poweron sent while cooling down, which lasts cool_time seconds after
+    poweroff. Held back commands are dropped after expiry seconds and if the
+    TV doesn't become ready within warm_timeout seconds.
+
+        power = PowerStateMachine(tv)
+        power.send('poweron')
+        power.send('inputhdmi2')
+        power.send('volumelevel', 12)
+        power.wait()
+
+    state is one of OFF, WARMING, ON, COOLING or None if not known yet.
+    '''
+
+    def __init__(self, tv, ready_command=None, poll_interval=0.5, warm_timeout=30,
+            cool_time=5, expiry=20):
+        self.tv = tv
+        if ready_command is None:
+            ready_command = 'inputstatus' if 'inputstatus' in tv.codes else 'mutestatus'
+        self.ready_command = ready_command
+        self.poll_interval = poll_interval
+        self.warm_timeout = warm_timeout
+        self.cool_time = cool_time
+        self.expiry = expiry
+        self.state = None
+        # time.monotonic() when state last changed
+        self.since = time.monotonic()
+        self.next_poll = self.since
+        # (command, data, callback, time.monotonic() to drop it at)
+        self.buffered = deque()
+
+    @property
+    def is_on(self):
+        '''True if the TV is on or turning on, as far as is known.'''
+        return self.state in (WARMING, ON)
+
+    @property
+    def ready(self):
+        return self.state == ON
+
+    def set_state(self, state):
+        if state != self.state:
+            if self.tv.verbose:
+                print('Power:', state)
+            self.state = state
+            # Replies from before might not be true anymore, like the TV
+            # looking ready because of a cached ready_command reply
+            self.tv.clear_cache()
+            self.since = time.monotonic()
+            self.next_poll = self.since + self.poll_interval
+
+    @staticmethod
+    def is_power_command(command):
+        return command.startswith('power') or command == 'togglepower'
+
+    def holds_back(self, command):
+        if command == 'poweron':
+            return self.state == COOLING
+        return self.state == WARMING and not self.is_power_command(command)
+
+    def send(self, command, data=None, callback=None):
+        '''Sends a command like LGTV.send() and returns what it returned, or
+        holds it back and returns BUFFERED if the TV can't take it yet.
+        callback, if given, is called with what LGTV.send() returned once it
+        was sent, or None if it was dropped.
+        '''
+        return self.send_or_buffer(command, data, callback, time.monotonic() + self.expiry)
+
+    def send_or_buffer(self, command, data, callback, expires):
+        if command == 'togglepower':
+            if self.state is None:
+                self.refresh()
+            command = 'poweroff' if self.is_on else 'poweron'
+        if self.holds_back(command):
+            self.buffered.append((command, data, callback, expires))
+            return BUFFERED
+        result = self.tv.send(command, data)
+        if self.is_power_command(command):
+            self.update(command, result)
+        if callback is not None:
+            callback(result)
+        return result
+
+    def update(self, command, result):
+        if result is None or result is SUPPRESSED:
+            return
+        if command == 'poweron':
+            if self.state != ON:
+                self.set_state(WARMING)
+        elif command == 'poweroff':
+            self.set_state(COOLING)
+            self.drop(lambda entry: True)
+        elif command == 'powerstatus':
+            if result and self.state in (None, OFF):
+                # Turned on some other way, maybe still warming up
+                self.set_state(WARMING)
+                self.next_poll = self.since
+            elif not result and self.state in (None, ON):
+                self.set_state(OFF)
+            # While warming up the TV might still say it's off and while
+            # cooling down it might still say it's on.
+
+    def refresh(self):
+        '''Asks the TV if it's on, unless it's warming up or cooling down, and
+        returns is_on.
+        '''
+        if self.state not in (WARMING, COOLING):
+            self.send('powerstatus')
+        return self.is_on
+
+    def drop(self, should_drop):
+        kept = deque()
+        for entry in self.buffered:
+            if should_drop(entry):
+                if entry[2] is not None:
+                    entry[2](None)
+            else:
+                kept.append(entry)
+        self.buffered = kept
+
+    def step(self):
+        '''Checks if a TV warming up is ready, ends cooling down and sends
+        held back commands that can be sent now. Returns the seconds until it
+        should be called again, or None if it doesn't need to be.
+        '''
+        now = time.monotonic()
+        self.drop(lambda entry: entry[3] <= now)
+        if self.state == WARMING and now >= self.next_poll:
+            if self.tv.send(self.ready_command) is not None:
+                self.set_state(ON)
+            elif now - self.since >= self.warm_timeout:
+                # Something went wrong, find out what it's doing next time
+                self.set_state(None)
+                self.drop(lambda entry: True)
+            else:
+                self.next_poll = time.monotonic() + self.poll_interval
+        elif self.state == COOLING and now - self.since >= self.cool_time:
+            self.set_state(OFF)
+
+        if self.buffered and self.state not in (WARMING, COOLING):
+            entries, self.buffered = self.buffered, deque()
+            for command, data, callback, expires in entries:
+                self.send_or_buffer(command, data, callback, expires)
+
+        if self.state == WARMING:
+            return max(self.next_poll - time.monotonic(), 0)
+        elif self.state == COOLING:
+            return max(self.since + self.cool_time - time.monotonic(), 0)
+        return None
+
+    def wait(self, timeout=None):
+        '''Calls step() until nothing is held back and the TV isn't warming up
+        or cooling down anymore. Returns False if timeout seconds passed first.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            due = self.step()
+            if due is None:
+                if not self.buffered:
+                    return True
+                due = self.poll_interval
+            if deadline is not None:
+                if time.monotonic() >= deadline:
+                    return False
+                due = min(due, deadline - time.monotonic())
+            time.sleep(max(due, 0))
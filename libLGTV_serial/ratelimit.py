@@ -0,0 +1,165 @@
+# Debouncing and rate limiting for LGTV.send(). The state is kept in a file for
+# each serial device, so every process sending to the same TV shares it, like
+# one started for every button press on a remote. json is only imported once
+# a limit is used, to keep the command line quick to start.
+import math
+import os
+import time
+
+from .filelock import FileLock, device_path, open_shared, read_shared
+
+LEADING = 'leading'
+TRAILING = 'trailing'
+
+
+class Suppressed:
+    def __repr__(self):
+        return 'SUPPRESSED'
+
+
+# Returned by LGTV.send() for commands that weren't sent because of
+# LGTV.debounce() or LGTV.rate_limit().
+SUPPRESSED = Suppressed()
+
+
+class Debounce:
+    '''Sends a command at most once every window seconds.
+
+    On the leading edge the first one is sent right away and the ones within
+    window seconds after it are suppressed. On the trailing edge they're all
+    suppressed and the last one is sent once window seconds have passed
+    without another.
+    '''
+
+    def __init__(self, window=0.5, edge=LEADING):
+        if edge not in (LEADING, TRAILING):
+            raise ValueError(f'edge has to be {LEADING!r} or {TRAILING!r}, not {edge!r}')
+        self.window = window
+        self.edge = edge
+
+    def check(self, state, now):
+        if self.edge == LEADING:
+            # Later than the window allows is someone messing with the file
+            if now < state.get('until', 0) <= now + self.window:
+                return False, None
+            state['until'] = state['expires'] = now + self.window
+            return True, None
+        # The one with the token in the state when the window is over is sent
+        token = os.urandom(8).hex()
+        state['pending'] = token
+        # Kept until it's sent, unless whatever was going to send it is gone
+        state['expires'] = now + self.window + 60
+        return False, token
+
+
+class TokenBucket:
+    '''Sends a command at most rate times a second on average, with up to
+    burst of them at once. The rest are suppressed.
+    '''
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0 or burst < 1:
+            raise ValueError('rate has to be more than 0 and burst at least 1')
+        self.rate = rate
+        self.burst = burst
+
+    def check(self, state, now):
+        updated = state.get('updated', now)
+        if updated > now:
+            # Someone messing with the file
+            tokens = self.burst
+        else:
+            tokens = min(self.burst,
+                max(state.get('tokens', self.burst), 0) + (now - updated) * self.rate)
+        if tokens < 1:
+            return False, None
+        tokens -= 1
+        state['tokens'] = tokens
+        state['updated'] = now
+        # When the bucket is full again
+        state['expires'] = now + (self.burst - tokens) / self.rate
+        return True, None
+
+
+# The types of what a state can have
+state_types = {'until': float, 'expires': float, 'tokens': float, 'updated': float,
+    'pending': str}
+
+
+def valid_state(state):
+    '''If state looks like something check() made. Anyone can write to the
+    file, so it's checked before using it.
+    '''
+    if not isinstance(state, dict) or 'expires' not in state:
+        return False
+    for name, value in state.items():
+        kind = state_types.get(name)
+        if kind is str:
+            if not isinstance(value, str):
+                return False
+        elif (kind is None or isinstance(value, bool) or not isinstance(value, (int, float))
+                or not math.isfinite(value)):
+            return False
+    return True
+
+
+class LimitStates:
+    '''The states of the limits for a serial device as a dict keyed by
+    LGTV.limit_key(), read from and written back to a file in the temporary
+    directory while holding its lock:
+
+        with LimitStates(port) as states:
+            ...
+    '''
+
+    def __init__(self, port):
+        self.path = device_path(port, '.limits')
+        self.lock = FileLock(self.path)
+        self.states = None
+
+    def __enter__(self):
+        import json
+        self.lock.acquire()
+        try:
+            states = json.loads(read_shared(self.path) or '{}')
+        except ValueError:
+            states = {}
+        if not isinstance(states, dict):
+            states = {}
+        # Forget the ones that are back to how they started
+        now = time.time()
+        self.states = {key: state for key, state in states.items()
+            if valid_state(state) and state['expires'] > now}
+        return self.states
+
+    def __exit__(self, type, value, traceback):
+        import json
+        try:
+            if type is None:
+                with os.fdopen(open_shared(self.path, os.O_WRONLY | os.O_TRUNC), 'w') as f:
+                    json.dump(self.states, f)
+        finally:
+            self.lock.release()
+
+
+def check_limit(limit, port, key):
+    '''Returns (send now, token). If token isn't None, the command is on the
+    trailing edge and has to be sent after limit.window seconds if
+    take_pending() returns True then.
+    '''
+    with LimitStates(port) as states:
+        # Wall clock time, since monotonic clocks might not be comparable
+        # between processes
+        return limit.check(states.setdefault(key, {}), time.time())
+
+
+def take_pending(port, key, token):
+    '''Returns True if the trailing edge command with token wasn't followed by
+    another one, so it's the one to send.
+    '''
+    with LimitStates(port) as states:
+        state = states.get(key)
+        if state is None or state.get('pending') != token:
+            return False
+        del state['pending']
+        return True
@@ -0,0 +1,218 @@
+# Records what goes over a serial device to a file and plays it back later, so
+# captures from real TVs can be used without them.
+#
+# Recordings are JSON lines, one per write or read, like
+#
+#     {"t": 0.000112, "tx": "ka 00 ff\r"}
+#     {"t": 0.021873, "rx": "a 01 OK01x"}
+#
+# where t is the seconds since recording started.
+import json
+import threading
+import time
+
+
+class Recorder:
+    '''Appends everything written to and read from the connections it wraps
+    to path. Set it as LGTV.recorder to record a TV:
+
+        tv.recorder = Recorder('session.jsonl')
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a', buffering=1)
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def log(self, direction, data):
+        line = json.dumps({
+            't': round(time.perf_counter() - self.start, 6),
+            direction: data.decode('latin-1'),
+        })
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def wrap(self, connection):
+        return RecordingSerial(connection, self)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class RecordingSerial:
+    '''A serial connection that logs writes and reads to a Recorder. Anything
+    else is passed on to the connection.
+    '''
+
+    def __init__(self, connection, recorder):
+        self.__dict__['connection'] = connection
+        self.__dict__['recorder'] = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    # So setting the timeout and such sets it on the connection
+    def __setattr__(self, name, value):
+        setattr(self.connection, name, value)
+
+    def write(self, data):
+        self.recorder.log('tx', data)
+        return self.connection.write(data)
+
+    def read(self, size=1):
+        data = self.connection.read(size)
+        if data:
+            self.recorder.log('rx', data)
+        return data
+
+    def read_until(self, expected=b'\n', size=None):
+        data = self.connection.read_until(expected, size)
+        if data:
+            self.recorder.log('rx', data)
+        return data
+
+
+def load(path):
+    '''Returns the (t, 'tx' or 'rx', bytes) in a recording.'''
+    entries = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            direction = 'tx' if 'tx' in entry else 'rx'
+            entries.append((entry['t'], direction, entry[direction].encode('latin-1')))
+    return entries
+
+
+class Replay:
+    '''Plays back a recording as if it was the serial device. Set its open
+    method as LGTV.transport:
+
+        tv.transport = Replay('session.jsonl').open
+
+    When something is written, the replay looks for the next time the same
+    thing was written in the recording and replies with what was read after
+    it, speed times faster than it was recorded or right away if speed is
+    None. If it can't find it, there's no reply, like a TV that's off. The
+    replay continues where it left off across opens, like a real TV would.
+
+    The connections can't be used with AsyncLGTV, which needs a file
+    descriptor to wait on.
+    '''
+
+    def __init__(self, path, speed=1.0):
+        self.entries = load(path)
+        self.speed = speed
+        # Index of the next entry to look for writes from
+        self.position = 0
+        # Writes that were found and that weren't
+        self.matched = 0
+        self.unmatched = 0
+
+    def open(self):
+        return ReplaySerial(self)
+
+    # Returns [(seconds after the write, bytes)] for the reply to data
+    def reply_to(self, data):
+        for i in range(self.position, len(self.entries)):
+            t, direction, recorded = self.entries[i]
+            if direction == 'tx' and recorded == data:
+                break
+        else:
+            self.unmatched += 1
+            return []
+        self.matched += 1
+        reply = []
+        for j in range(i + 1, len(self.entries)):
+            rx_t, direction, recorded = self.entries[j]
+            if direction == 'tx':
+                break
+            delay = 0 if self.speed is None else (rx_t - t) / self.speed
+            reply.append((delay, recorded))
+        self.position = j if reply else i + 1
+        return reply
+
+
+class ReplaySerial:
+    '''The part of serial.Serial that LGTV uses, replying from a Replay.'''
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.timeout = 1
+        self.is_open = True
+        self.buffer = b''
+        # [(time.monotonic() it arrives at, bytes)]
+        self.pending = []
+
+    def arrived(self):
+        now = time.monotonic()
+        while self.pending and self.pending[0][0] <= now:
+            self.buffer += self.pending.pop(0)[1]
+
+    @property
+    def in_waiting(self):
+        self.arrived()
+        return len(self.buffer)
+
+    def reset_input_buffer(self):
+        self.arrived()
+        self.buffer = b''
+
+    def write(self, data):
+        now = time.monotonic()
+        for delay, reply in self.replay.reply_to(bytes(data)):
+            self.pending.append((now + delay, reply))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    # Reads until done(data) returns how much of it to return, or until the
+    # timeout, when up to size bytes of what arrived are returned.
+    def read_while(self, done, size):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            self.arrived()
+            end = done(self.buffer)
+            if end is None:
+                now = time.monotonic()
+                wait = self.pending[0][0] - now if self.pending else None
+                if wait is None and (deadline is None or self.replay.speed is None):
+                    # Nothing else is coming, don't wait for it
+                    end = len(self.buffer)
+                elif deadline is not None and (wait is None or now + wait > deadline):
+                    time.sleep(max(deadline - now, 0))
+                    self.arrived()
+                    end = len(self.buffer)
+                else:
+                    time.sleep(max(wait, 0))
+                    continue
+                if size is not None:
+                    end = min(end, size)
+            data, self.buffer = self.buffer[:end], self.buffer[end:]
+            return data
+
+    def read(self, size=1):
+        return self.read_while(lambda buf: size if len(buf) >= size else None, size)
+
+    def read_until(self, expected=b'\n', size=None):
+        def done(buf):
+            end = buf.find(expected)
+            if end >= 0:
+                end += len(expected)
+                return end if size is None else min(end, size)
+            if size is not None and len(buf) >= size:
+                return size
+            return None
+        return self.read_while(done, size)
+
+    def close(self):
+        self.is_open = False
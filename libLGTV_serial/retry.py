@@ -0,0 +1,75 @@
+import time
+
+
+class LGTVTimeoutError(TimeoutError):
+    '''Raised when something that's retried, like opening the serial device,
+    ran out of attempts or time.
+    '''
+    pass
+
+
+class RetryPolicy:
+    '''How to retry something that failed: after the first failure wait delay
+    seconds, then multiplier times longer after each failure after that, up to
+    max_delay. Each wait is randomly made up to jitter (0.1 is 10%) shorter or
+    longer, so processes retrying the same device don't stay in step. Gives up
+    after attempts tries in total or once timeout seconds have passed since
+    the first one, either can be None for no limit.
+
+        tv.open_retry = RetryPolicy(timeout=30)
+        tv.command_retry = RetryPolicy(attempts=3, timeout=2)
+    '''
+
+    def __init__(self, attempts=None, timeout=None, delay=0.05, multiplier=2.0,
+            max_delay=1.0, jitter=0.1):
+        if attempts is not None and attempts < 1:
+            raise ValueError(f'attempts {attempts!r} is less than 1')
+        self.attempts = attempts
+        self.timeout = timeout
+        self.delay = delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def deadline(self, start=None):
+        '''Returns the time.monotonic() at which to give up when starting at
+        start (now by default), or None if there's no timeout.
+        '''
+        if self.timeout is None:
+            return None
+        return (time.monotonic() if start is None else start) + self.timeout
+
+    def delays(self, deadline=None):
+        '''Yields the seconds to wait before each retry, stopping when there
+        are no attempts left or when the next try would be past deadline (a
+        time.monotonic() time, the earlier of it and the policy's own timeout
+        is used).
+        '''
+        own_deadline = self.deadline()
+        if deadline is None or (own_deadline is not None and own_deadline < deadline):
+            deadline = own_deadline
+        delay = self.delay
+        attempt = 1
+        while self.attempts is None or attempt < self.attempts:
+            wait = delay
+            if self.jitter:
+                import random # Only needed when something failed
+                wait *= 1 + random.uniform(-self.jitter, self.jitter)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                # Use what's left for one last try
+                wait = min(wait, remaining)
+            yield wait
+            delay = min(delay * self.multiplier, self.max_delay)
+            attempt += 1
+
+
+def remaining(deadline):
+    '''Seconds left until deadline, raises LGTVTimeoutError if there are none.
+    '''
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise LGTVTimeoutError('Ran out of time')
+    return left
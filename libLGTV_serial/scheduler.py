@@ -0,0 +1,106 @@
+import threading
+from functools import partial
+
+
+class CommandScheduler:
+    '''Queues commands for a TV and runs them later with run_pending(), so that
+    a burst of commands (like someone dragging a volume slider) only costs as
+    many round-trips as needed.
+
+    Absolute writes to the same command family, which is the first 2 letters
+    of the code like "kf" for volume or "xb" for input, replace each other in
+    the queue so only the latest one is sent, in the place of the latest one.
+    Queued status reads of the same family are merged into one read that
+    happens after the writes queued before it. Relative commands like toggles
+    and volumeup are always sent.
+
+    send is called as send(command, data) to run a command, usually LGTV.send.
+    If deferred is True it's called as send(command, data, callback) instead
+    and has to call callback with the result itself, which lets it run the
+    command later, like PowerStateMachine.send. codes is the command to code
+    table, usually LGTV.codes.
+    '''
+
+    def __init__(self, send, codes, max_depth=64, deferred=False):
+        self.send = send
+        self.codes = codes
+        self.max_depth = max_depth
+        self.deferred = deferred
+        self.lock = threading.Lock()
+        # key -> [command, data, callbacks], in the order they will be run
+        self.pending = {}
+        self.unique = 0
+        # Writes replaced by a newer write of the same family
+        self.coalesced = 0
+        # Status reads merged into an already queued read
+        self.merged = 0
+        # Commands not queued because the queue was full
+        self.dropped = 0
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    @staticmethod
+    def is_read(command, data):
+        return data is None and (command.endswith('status') or command.endswith('level'))
+
+    def key_for(self, command, data):
+        code = self.codes.get(command)
+        if code is None or command.startswith('toggle'):
+            # Relative or unknown command, never coalesce it
+            self.unique += 1
+            return self.unique
+        return (code[:2], self.is_read(command, data))
+
+    def submit(self, command, data=None, callback=None):
+        '''Queue a command. callback, if given, is called with what send
+        returned once it has run. Returns False if the queue was full.
+        '''
+        with self.lock:
+            key = self.key_for(command, data)
+            entry = self.pending.get(key)
+            if entry is None:
+                if len(self.pending) >= self.max_depth:
+                    self.dropped += 1
+                    return False
+                self.pending[key] = [command, data, []]
+            else:
+                # Move to the back, so a read reads the result of any write
+                # queued since it was first queued and a write isn't run
+                # before commands queued before it, like volumeup.
+                self.pending[key] = self.pending.pop(key)
+                if self.is_read(command, data):
+                    self.merged += 1
+                else:
+                    entry[0] = command
+                    entry[1] = data
+                    self.coalesced += 1
+            callbacks = self.pending[key][2]
+            if callback is not None and callback not in callbacks:
+                callbacks.append(callback)
+            return True
+
+    def pop(self):
+        with self.lock:
+            if not self.pending:
+                return None
+            key = next(iter(self.pending))
+            return self.pending.pop(key)
+
+    def run_pending(self):
+        '''Run everything queued so far in order.'''
+        while True:
+            entry = self.pop()
+            if entry is None:
+                break
+            command, data, callbacks = entry
+            if self.deferred:
+                self.send(command, data, partial(self.call, callbacks))
+            else:
+                self.call(callbacks, self.send(command, data))
+
+    @staticmethod
+    def call(callbacks, result):
+        for callback in callbacks:
+            callback(result)
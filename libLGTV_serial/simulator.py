@@ -0,0 +1,184 @@
+import os
+import pty
+import tty
+import time
+import random
+import threading
+
+from . import LGTV
+
+
+class TvSimulator:
+    '''Pretends to be an LG TV on the other end of a pseudo-terminal, so LGTV
+    and lgtv-mqtt.py can be run without a real TV. Only works on Linux and
+    other Unixes with ptys.
+
+    Use it by passing port to LGTV after calling start():
+
+        sim = TvSimulator('42LK450').start()
+        tv = LGTV('42LK450', sim.port)
+
+    It keeps track of the state for each command family like power, input,
+    volume and mute, and replies like a real TV would. Faults can be injected:
+
+    - latency: Seconds to wait before replying
+    - drop_rate: Chance of each byte of a reply being lost
+    - ng_rate: Chance of replying NG to a valid command
+    - power_on_delay: Seconds after poweron before anything other than power
+      commands are accepted
+    - baudrate: Only reply if the serial device was opened at this baud rate
+    '''
+
+    max_volume = 100
+
+    def __init__(self, model, set_id=1, latency=0.0, drop_rate=0.0, ng_rate=0.0,
+            power_on_delay=0.0, seed=None, baudrate=None):
+        self.tv = LGTV(model)
+        self.set_id = set_id
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.ng_rate = ng_rate
+        self.power_on_delay = power_on_delay
+        self.baudrate = baudrate
+        self.random = random.Random(seed)
+
+        # Valid data for each family that only takes fixed values
+        self.valid_data = {}
+        for code in self.tv.codes.values():
+            if not code.endswith(b'ff'):
+                self.valid_data.setdefault(code[:2], set()).add(code[-2:])
+        self.state = {family: min(data) for family, data in self.valid_data.items()}
+        self.state[b'ka'] = b'00' # Start off
+        self.state[b'kf'] = b'0a'
+        self.state[b'ke'] = b'01' # Not muted
+        self.powered_on_at = None
+
+        self.received = 0
+        self.master_fd = None
+        self.slave_fd = None
+        self.port = None
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        for fd in (self.master_fd, self.slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def warming_up(self):
+        return (self.powered_on_at is not None and
+            time.monotonic() - self.powered_on_at < self.power_on_delay)
+
+    # The baud rate set on a pty doesn't matter, but it can be read back
+    def at_baudrate(self):
+        if self.baudrate is None:
+            return True
+        import termios
+        return termios.tcgetattr(self.slave_fd)[4] == getattr(termios, f'B{self.baudrate}', None)
+
+    def respond(self, line):
+        '''Returns the reply to a command like b"ka 00 01" or None if the TV
+        wouldn't reply at all.
+        '''
+        parts = line.strip().lower().split(b' ')
+        if len(parts) != 3 or len(parts[0]) != 2 or len(parts[1]) != 2 or len(parts[2]) != 2:
+            return None
+        family, set_id, data = parts
+        try:
+            sent_set_id = int(set_id, 16)
+            int(data, 16)
+        except ValueError:
+            return None
+        if sent_set_id not in (0, self.set_id):
+            return None
+        self.received += 1
+
+        ok = family in self.state
+        if ok and family != b'ka':
+            # Only power commands work while off or warming up
+            ok = self.state[b'ka'] == b'01' and not self.warming_up()
+        if ok and data != b'ff':
+            if family == b'kf':
+                ok = int(data, 16) <= self.max_volume
+            else:
+                ok = data in self.valid_data[family]
+        if ok and self.random.random() < self.ng_rate:
+            ok = False
+
+        if ok and data != b'ff':
+            if family == b'ka' and data == b'01' and self.state[b'ka'] == b'00':
+                self.powered_on_at = time.monotonic()
+            self.state[family] = data
+        reply_data = self.state.get(family, data) if ok and data == b'ff' else data
+        status = b'OK' if ok else b'NG'
+        return family[1:2] + b' ' + f'{self.set_id:02x}'.encode() + b' ' + status + reply_data + b'x'
+
+    def drop_bytes(self, reply):
+        if not self.drop_rate:
+            return reply
+        return bytes(b for b in reply if self.random.random() >= self.drop_rate)
+
+    def serve(self):
+        buf = b''
+        while self.running:
+            try:
+                data = os.read(self.master_fd, 64)
+            except OSError:
+                break
+            buf += data
+            while b'\r' in buf:
+                line, buf = buf.split(b'\r', 1)
+                reply = self.respond(line)
+                if reply is None or not self.at_baudrate():
+                    continue
+                if self.latency:
+                    time.sleep(self.latency)
+                try:
+                    os.write(self.master_fd, self.drop_bytes(reply))
+                except OSError:
+                    return
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Simulate an LG TV on a pseudo-terminal')
+    parser.add_argument('model', metavar='MODEL')
+    parser.add_argument('-i', '--set-id', metavar='SET_ID', type=int, default=1)
+    parser.add_argument('--latency', metavar='SECONDS', type=float, default=0.0)
+    parser.add_argument('--drop-rate', metavar='CHANCE', type=float, default=0.0)
+    parser.add_argument('--ng-rate', metavar='CHANCE', type=float, default=0.0)
+    parser.add_argument('--power-on-delay', metavar='SECONDS', type=float, default=0.0)
+    parser.add_argument('--baudrate', metavar='RATE', type=int,
+        help='Only reply at this baud rate')
+    args = parser.parse_args()
+
+    sim = TvSimulator(args.model, args.set_id, args.latency, args.drop_rate,
+        args.ng_rate, args.power_on_delay, baudrate=args.baudrate).start()
+    print(sim.port, flush=True)
+    try:
+        sim.thread.join()
+    except KeyboardInterrupt:
+        pass
+    sim.stop()
+
+
+if __name__ == '__main__':
+    main()
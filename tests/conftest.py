@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libLGTV_serial import LGTV
+from libLGTV_serial.simulator import TvSimulator
+
+model = '42LK450'
+
+
+@pytest.fixture
+def sim():
+    with TvSimulator(model) as sim:
+        yield sim
+
+
+# A TV that's on, talking to sim
+@pytest.fixture
+def tv(sim):
+    tv = LGTV(model, sim.port)
+    tv.response_timeout = 0.3
+    assert tv.send('poweron')
+    yield tv
+    tv.close()
+
+
+@pytest.fixture
+def lgtv_mqtt():
+    from benchmark import load_lgtv_mqtt
+    return load_lgtv_mqtt()
@@ -0,0 +1,62 @@
+import asyncio
+import os
+
+import pytest
+
+from libLGTV_serial import LGTV, device_path
+from libLGTV_serial.aio import AsyncLGTV
+from libLGTV_serial.simulator import TvSimulator
+from conftest import model
+
+
+# Only replies at 19200 baud, with no rate remembered for it
+@pytest.fixture
+def sim():
+    with TvSimulator(model, baudrate=19200) as sim:
+        path = device_path(sim.port, '.baud')
+        if os.path.exists(path):
+            os.unlink(path)
+        yield sim
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def cached(sim):
+    path = device_path(sim.port, '.baud')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return int(f.read())
+
+
+def test_probe_finds_and_remembers_the_rate(sim):
+    tv = LGTV(model, sim.port)
+    assert tv.probe_baudrate((115200, 19200, 9600), timeout=0.2) == 19200
+    assert tv.serial_settings['baudrate'] == 19200
+    assert cached(sim) == 19200
+    assert tv.send('powerstatus') == 0
+    # Remembered, so 9600 isn't tried even though it would reply now
+    sim.baudrate = None
+    assert LGTV(model, sim.port).probe_baudrate((9600, 19200)) == 19200
+
+
+def test_remembered_rate_has_to_be_a_candidate(sim):
+    with open(device_path(sim.port, '.baud'), 'w') as f:
+        f.write('1234567')
+    assert LGTV(model, sim.port).probe_baudrate((19200, 9600), timeout=0.2) == 19200
+    assert cached(sim) == 19200
+
+
+def test_probe_without_reply_changes_nothing(sim):
+    tv = LGTV(model, sim.port)
+    assert tv.probe_baudrate((1234567, 9600), timeout=0.2) is None
+    assert tv.serial_settings['baudrate'] == 9600
+    assert cached(sim) is None
+
+
+def test_async_probe(sim):
+    tv = AsyncLGTV(model, sim.port)
+    assert asyncio.run(tv.probe_baudrate((1234567, 9600), timeout=0.2)) is None
+    assert cached(sim) is None
+    assert asyncio.run(tv.probe_baudrate((1234567, 19200), timeout=0.2)) == 19200
+    assert cached(sim) == 19200
@@ -0,0 +1,8 @@
+from benchmark import bench_import, import_budget_ms
+
+
+def test_command_line_import_is_within_budget():
+    result = bench_import(5)
+    assert not result['imports_serial'], 'importing for the command line imported serial'
+    assert result['p50_us'] <= import_budget_ms * 1000, \
+        f'importing for the command line took {result["p50_us"] / 1000:.1f} ms'
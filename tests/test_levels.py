@@ -0,0 +1,26 @@
+import pytest
+
+
+def test_volume_up_stops_at_maximum(tv, sim):
+    assert tv.send('volumelevel', 98) == 98
+    assert tv.send('volumeup', 300) is True
+    assert sim.state[b'kf'] == b'64'
+
+
+def test_volume_down_stops_at_zero(tv, sim):
+    assert tv.send('volumedown', 300) is True
+    assert sim.state[b'kf'] == b'00'
+
+
+def test_ramp_stops_at_maximum(tv, sim):
+    assert tv.ramp('volumelevel', delta=200, interval=0)
+    assert tv.send('volumelevel') == 100
+
+
+@pytest.mark.parametrize('level, delta, expected', [
+    (b'fe', 1, b'fe'),
+    (b'f0', 300, b'fe'),
+    (b'05', -10, b'00'),
+])
+def test_delta_never_sends_the_query_data(tv, level, delta, expected):
+    assert tv.hex_bytes_delta(level, delta) == expected
@@ -0,0 +1,13 @@
+from datetime import timedelta
+
+from benchmark import NullMqttClient
+
+
+def test_fake_tv_with_metrics_interval_does_not_spin(lgtv_mqtt):
+    # Fake TVs have no metrics, that mustn't leave the metrics always due
+    controller = lgtv_mqtt.TvController(lgtv_mqtt.FakeTvWrapper(), 'lgtv/',
+        timedelta(seconds=15), NullMqttClient(), metrics_interval=timedelta(seconds=5))
+    # Like the metrics interval having passed
+    controller.last_metrics -= timedelta(seconds=10)
+    controller.work()
+    assert controller.update_due_in() > 1
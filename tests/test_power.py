@@ -0,0 +1,19 @@
+from libLGTV_serial.power import COOLING, ON, WARMING, PowerStateMachine
+
+
+def test_cached_reply_does_not_make_warming_tv_ready(sim, tv):
+    tv.enable_cache(60)
+    assert tv.send('inputstatus') is not None
+    power = PowerStateMachine(tv, poll_interval=0, cool_time=0)
+    power.send('poweroff')
+    assert power.state == COOLING
+    power.step()
+    # From now on the TV rejects everything but power commands for a while
+    sim.power_on_delay = 5
+    power.send('poweron')
+    assert power.state == WARMING
+    power.step()
+    assert power.state == WARMING
+    sim.power_on_delay = 0
+    power.step()
+    assert power.state == ON
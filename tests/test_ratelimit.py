@@ -0,0 +1,77 @@
+import json
+import os
+import time
+
+from libLGTV_serial import SUPPRESSED, device_path
+from libLGTV_serial.filelock import port_lock
+
+
+def write_limits(sim, states):
+    with open(device_path(sim.port, '.limits'), 'w') as f:
+        json.dump(states, f)
+
+
+def test_debounce(tv):
+    tv.debounce('poweron', 5)
+    assert tv.send('poweron') is True
+    assert tv.send('poweron') is SUPPRESSED
+
+
+def test_tampered_states_are_ignored(tv, sim):
+    tv.debounce('poweron', 0.5)
+    tv.rate_limit('powerstatus', 1)
+    now = time.time()
+    write_limits(sim, {
+        # Longer than the window
+        '0 poweron': {'until': now + 3600, 'expires': now + 3600},
+        '0 powerstatus': {'tokens': 0, 'updated': now + 3600, 'expires': now + 3600},
+    })
+    assert tv.send('poweron') is True
+    assert tv.send('powerstatus') == 1
+    write_limits(sim, {'0 poweron': {'until': 'soon', 'expires': [], 'x': 1}})
+    assert tv.send('poweron') is True
+    write_limits(sim, ['not', 'a', 'dict'])
+    assert tv.send('poweron') is True
+    assert tv.send('poweron') is SUPPRESSED
+
+
+def test_state_files_are_not_followed_through_symlinks(tv, sim, tmp_path):
+    target = tmp_path / 'target'
+    target.write_text('keep')
+    path = device_path(sim.port, '.limits')
+    if os.path.exists(path):
+        os.unlink(path)
+    os.symlink(target, path)
+    try:
+        tv.debounce('poweron', 0.5)
+        try:
+            tv.send('poweron')
+        except OSError:
+            pass
+        assert target.read_text() == 'keep'
+    finally:
+        os.unlink(path)
+
+
+def test_lock_files_are_not_world_writable(sim):
+    path = device_path(sim.port) + '.lock'
+    if os.path.exists(path):
+        os.unlink(path)
+    with port_lock(sim.port):
+        pass
+    assert os.stat(path).st_mode & 0o777 == 0o644
+
+
+def test_port_lock_wait_is_bounded_by_the_deadline(tv, sim):
+    from libLGTV_serial import RetryPolicy
+    from libLGTV_serial.filelock import FileLockException
+    tv.command_retry = RetryPolicy(attempts=1, timeout=0.2)
+    with port_lock(sim.port):
+        start = time.monotonic()
+        try:
+            tv.send('powerstatus')
+        except (FileLockException, TimeoutError):
+            pass
+        else:
+            raise AssertionError('sent while the port was locked')
+        assert time.monotonic() - start < 1
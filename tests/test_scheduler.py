@@ -0,0 +1,35 @@
+from libLGTV_serial.scheduler import CommandScheduler
+
+
+def run(tv, *commands):
+    sent = []
+
+    def send(command, data):
+        sent.append((command, data))
+        return tv.send(command, data)
+
+    scheduler = CommandScheduler(send, tv.codes)
+    for command in commands:
+        scheduler.submit(*command)
+    scheduler.run_pending()
+    return sent
+
+
+def test_coalesced_write_runs_after_commands_queued_before_it(tv):
+    sent = run(tv, ('volumelevel', 10), ('volumeup', None), ('volumelevel', 20))
+    assert sent == [('volumeup', None), ('volumelevel', 20)]
+    assert tv.send('volumelevel') == 20
+
+
+def test_last_power_command_wins(tv):
+    sent = run(tv, ('poweroff', None), ('inputhdmi1', None), ('poweron', None))
+    assert sent == [('inputhdmi1', None), ('poweron', None)]
+    assert tv.send('powerstatus') == 1
+
+
+def test_read_after_writes(tv):
+    results = []
+    sent = run(tv, ('volumelevel', 10), ('volumelevel', None, results.append),
+        ('volumelevel', 30), ('volumelevel', None, results.append))
+    assert sent == [('volumelevel', 30), ('volumelevel', None)]
+    assert results == [30]
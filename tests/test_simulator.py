@@ -0,0 +1,35 @@
+from libLGTV_serial import LGTV
+from conftest import model
+
+
+def test_power_gates_other_commands(sim):
+    tv = LGTV(model, sim.port)
+    tv.response_timeout = 0.3
+    assert tv.send('powerstatus') == 0
+    assert tv.send('inputhdmi1') is None
+    assert tv.last_result == 'ng'
+    assert tv.send('poweron') is True
+    assert tv.send('inputhdmi1') is True
+    assert tv.send('inputstatus') == 'hdmi1'
+
+
+def test_levels_round_trip(tv):
+    assert tv.send('volumelevel', 30) == 30
+    assert tv.send('volumelevel') == 30
+    assert tv.send('volumeup', 2) is True
+    assert tv.send('volumelevel') == 32
+
+
+def test_set_id_is_addressed(sim):
+    assert LGTV(model, sim.port, set_id=sim.set_id).send('powerstatus') == 0
+    other = LGTV(model, sim.port, set_id=sim.set_id + 1)
+    other.response_timeout = 0.2
+    assert other.send('powerstatus') is None
+    assert other.last_result == 'timeout'
+
+
+def test_cached_level_write_reaches_tv(tv, sim):
+    tv.enable_cache(5)
+    assert tv.send('volumelevel') == 10
+    assert tv.send('volumelevel', 30) == 30
+    assert sim.state[b'kf'] == b'1e'